@@ -0,0 +1,248 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import os
+import sys
+import json
+import multiprocessing
+from multiprocessing.util import Finalize
+from argparse import ArgumentParser
+from os.path import dirname, join, splitext
+
+import arcache
+import arclient
+import armirror
+import arstore
+import arverify
+import utils
+from utils import SubprocessError, NotFromCDError,\
+    AccurateripError, NetworkError, DecodeError, CueError, DependencyError
+from utils import AUDIO_EXTENSIONS
+
+PROGNAME = 'arbatch'
+VERSION = '0.2'
+PROCS = []
+
+DISC_ERRORS = (SubprocessError, NotFromCDError, AccurateripError,
+               NetworkError, DecodeError, CueError, DependencyError,
+               IOError, OSError)
+
+def process_arguments():
+    parser = \
+        ArgumentParser(description='Verify many discs with accuraterip.',
+                       prog=PROGNAME)
+    parser.add_argument('dirs', metavar='dir', nargs='*',
+                        type=utils.isdir,
+                        help='directory tree to search for discs '
+                        '(one directory per disc)')
+    parser.add_argument('-m', '--manifest', action='append', default=[],
+                        type=utils.isfile,
+                        help='file listing one audio file per line, '
+                        'discs separated by blank lines')
+    parser.add_argument('-o', '--output',
+                        help='write results to this file instead of stdout '
+                        '(one JSON record per disc)')
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of discs to verify in parallel",
+                        )
+    parser.add_argument("-e", "--engine",
+                        choices=['ckcdda', 'numpy'],
+                        default='ckcdda',
+                        help="calculate checksums with the ckcdda program "
+                        "or in-process with numpy",
+                        )
+    parser.add_argument("--prefetch", action='store_true', default=False,
+                        help="look up the database entries of all discs "
+                        "before verifying them",
+                        )
+    parser.add_argument("--lookup-jobs", dest="lookup_jobs", type=int,
+                        default=arclient.DEFAULT_JOBS,
+                        help="number of database lookups to run at a time "
+                        "when prefetching (default: %(default)s)",
+                        )
+    arcache.add_cache_arguments(parser)
+    arclient.add_client_arguments(parser)
+    armirror.add_mirror_arguments(parser)
+    arstore.add_store_arguments(parser)
+    utils.add_common_arguments(parser, VERSION)
+
+    options = parser.parse_args()
+    if options.offline and not options.cache:
+        parser.error('--offline requires the cache')
+    arclient.check_client_options(parser, options)
+    if options.prefetch and not options.cache:
+        parser.error('--prefetch requires the cache')
+    if options.lookup_jobs < 1:
+        parser.error('--lookup-jobs must be at least 1')
+    if not options.dirs and not options.manifest:
+        parser.error('no directories or manifests given')
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return options
+
+def find_discs(top):
+    """Yield the audio files of every directory below top as one disc
+
+    A directory with one audio file and a CUE sheet is an image rip and
+    yields the CUE sheet instead.
+    """
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        paths = [join(dirpath, f) for f in sorted(filenames)
+                 if splitext(f)[1].lower() in AUDIO_EXTENSIONS]
+        cues = [join(dirpath, f) for f in sorted(filenames)
+                if f.lower().endswith('.cue')]
+        if len(paths) == 1 and cues:
+            yield cues[:1]
+        elif paths:
+            yield paths
+
+def read_manifest(path):
+    """Yield the discs listed in a manifest file"""
+    paths = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            if line:
+                paths.append(line)
+            elif paths:
+                yield paths
+                paths = []
+    if paths:
+        yield paths
+
+def track_record(track):
+    return dict(path=track.path,
+                name=track.name,
+                crc1=getattr(track, 'crc1', None),
+                crc2=getattr(track, 'crc2', None),
+                crc450=getattr(track, 'crc450', None),
+                submissions=track.num_submissions,
+                exact_matches=track.exact_matches,
+                possible_matches=track.possible_matches,
+                )
+
+def init_worker(BIN, cache, client, store, mirror=None):
+    arverify.BIN.update(BIN)
+    arverify.CACHE = cache
+    arverify.MIRROR = mirror
+    arverify.CLIENT = client
+    arverify.STORE = store
+    utils.QUIET = True
+    utils.init_worker()
+    # the connections are reused by every disc of the worker
+    Finalize(client, client.close, exitpriority=10)
+
+def disc_key(paths):
+    """The database key of a disc, or None if it can't be read"""
+    try:
+        tracks, additional_sectors = arverify.get_tracks(paths)
+        cddb, id1, id2 = arverify.get_disc_ids(tracks, additional_sectors)
+    except Exception:
+        # verify_disc reports the error
+        return None
+    return (len(tracks), id1, id2, cddb)
+
+def verify_disc(args):
+    """Pool job: verify one disc and return its results record"""
+    paths, engine = args
+    record = dict(paths=paths)
+    del arverify.PROCS[:]
+    try:
+        tracks, additional_sectors = arverify.get_tracks(paths)
+        cddb, id1, id2 = arverify.get_disc_ids(tracks, additional_sectors)
+        record['disc_id'] = '%08x-%08x-%08x' % (id1, id2, cddb)
+        hits = arverify.CACHE.hits if arverify.CACHE else 0
+        stored = arverify.STORE.hits if arverify.STORE else 0
+        arverify.verify_tracks(tracks, cddb, id1, id2, engine)
+        if arverify.CACHE:
+            record['cache'] = 'hit' if arverify.CACHE.hits > hits else 'miss'
+        if arverify.STORE:
+            record['store'] = 'hit' if arverify.STORE.hits > stored else 'miss'
+        record['status'] = arverify.disc_status(tracks)
+        record['tracks'] = [track_record(t) for t in tracks]
+    except DISC_ERRORS as e:
+        record['status'] = 'error'
+        record['error'] = str(e).strip()
+    except Exception as e:
+        # a bug hit by one disc mustn't stop the run
+        record['status'] = 'error'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        for p in arverify.PROCS:
+            try: p.kill()
+            except OSError: pass
+    return record
+
+def main(options):
+    required = arverify.REQUIRED
+    if options.engine == 'numpy':
+        arverify.arcf.check_numpy()
+        required = [r for r in required if r != 'ckcdda']
+    utils.check_dependencies(arverify.BIN, required)
+
+    discs = []
+    for top in options.dirs:
+        discs.extend(find_discs(top))
+    for path in options.manifest:
+        discs.extend(read_manifest(path))
+
+    out = open(options.output, 'w') if options.output else sys.stdout
+    counts = {}
+    cache = arcache.from_options(options)
+    client = arclient.from_options(options)
+    store = arstore.from_options(options)
+    mirror = armirror.from_options(options)
+    if options.prefetch and not options.offline:
+        keys = [k for k in map(disc_key, discs) if k]
+        if mirror:
+            keys = [k for k in keys if mirror.find(k) is None]
+        n = arclient.prefetch(client, cache, keys, options.lookup_jobs)
+        client.close()
+        if options.verbose:
+            print('Prefetched %i of %i database entries' % (n, len(keys)),
+                  file=sys.stderr)
+    pool = multiprocessing.Pool(options.jobs, init_worker,
+                                (arverify.BIN, cache, client, store, mirror))
+    try:
+        jobs = [(paths, options.engine) for paths in discs]
+        for n, record in enumerate(pool.imap(verify_disc, jobs), start=1):
+            out.write(json.dumps(record, sort_keys=True)+'\n')
+            out.flush()
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            if record.get('cache') == 'hit':
+                cache.hits += 1
+            elif record.get('cache') == 'miss':
+                cache.misses += 1
+            if record.get('store') == 'hit':
+                store.hits += 1
+            elif record.get('store') == 'miss':
+                store.misses += 1
+            if options.verbose:
+                print('%i/%i %s: %s' % (n, len(discs), record['status'],
+                                        dirname(record['paths'][0])),
+                      file=sys.stderr)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    pool.close()
+    pool.join()
+
+    print('%i discs: %s' % (len(discs), ', '.join(
+        '%i %s' % (counts[s], s) for s in sorted(counts))), file=sys.stderr)
+    if cache and options.verbose:
+        print(cache.summary(), file=sys.stderr)
+    if store:
+        print(store.summary(), file=sys.stderr)
+
+    return 1 if counts.get('not accurate') or counts.get('error') else 0
+
+if __name__ == '__main__':
+    utils.execute(main, process_arguments, PROCS)
@@ -0,0 +1,557 @@
+#!/usr/bin/python
+"""Benchmarks on a synthetic CD-audio corpus
+
+The corpus is a set of albums of random noise WAV tracks whose lengths are
+multiples of 588 samples, plus a dBAR file for every album in a dBAR cache
+directory, so everything runs offline. Every stage runs in a fresh Python
+process, which reports its time and peak RSS (its own or that of its
+largest child); the best of --repeat runs counts. Rates can be saved as a
+baseline and later runs fail if a stage got slower than the baseline by
+more than --threshold.
+
+--check instead compares the checksums of ckcdda (and of the numpy engine,
+if it's installed) with ones calculated straight from their definitions
+on random albums, for several radii and track lengths.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import operator
+import tempfile
+from argparse import ArgumentParser, SUPPRESS
+from array import array
+from os.path import abspath, dirname, exists, isdir, join
+from subprocess import Popen, PIPE
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import arcache
+import arcf
+import arprofile
+import arverify
+import fixoffset
+import utils
+
+PROGNAME = 'arbench'
+VERSION = '0.2'
+PROCS = []
+
+# track lengths in seconds before scaling
+ALBUMS = [('single', [600]),
+          ('typical', [240]*12),
+          ('many', [45]*40),
+          ]
+STAGES = ['ckcdda', 'scan-ckcdda', 'scan-parallel', 'scan-numpy', 'disc-ids',
+          'dbar-parse', 'fixoffset-wav', 'fixoffset-flac', 'verify']
+DBAR_RESPONSES = 20
+DISC_ID_CALLS = 20000
+DBAR_PARSES = 200
+FIX_OFFSET = 667
+CORPUS_VERSION = 1
+# (radius, track lengths in sectors) of the albums checked by --check;
+# tracks of 451 sectors or more have CRC450s
+CHECK_CASES = [(0, [10, 1, 460]),
+               (1, [455, 2, 12]),
+               (7, [12, 452]),
+               (5, [455]),
+               (588, [451, 3, 460]),
+               (arcf.CHECK_RADIUS, [460, 10, 20]),
+               (5000, [23, 18, 452]),
+               ]
+# (radius, track lengths in sectors) of albums with a track too short for
+# its window, which --check expects every engine to reject
+CHECK_SHORT_CASES = [(arcf.CHECK_RADIUS, [10]),
+                     (5, [460, 4]),
+                     (588, [5, 460]),
+                     ]
+# offsets checked besides -radius, -radius+1, -1, 0, 1, radius-1, radius
+CHECK_RANDOM_OFFSETS = 8
+
+def process_arguments():
+    parser = \
+        ArgumentParser(description='Benchmark the checksum, lookup and '
+                       'offset fixing stages on a synthetic corpus.',
+                       prog=PROGNAME)
+    parser.add_argument("-c", "--corpus",
+                        help="directory of the corpus, generated if it "
+                        "doesn't match the options (default: a temporary "
+                        "directory)",
+                        )
+    parser.add_argument("-s", "--stage", action='append',
+                        choices=STAGES,
+                        help="run only this stage (may be repeated)",
+                        )
+    parser.add_argument("--scale", type=float, default=0.1,
+                        help="scale the track lengths of the corpus "
+                        "(default: %(default)s, about 7 minutes of audio)",
+                        )
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the corpus (default: %(default)s)",
+                        )
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="runs per stage, the fastest counts "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="jobs of the fixoffset stages and decode "
+                        "jobs of scan-parallel "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("-b", "--baseline",
+                        help="compare the rates with this baseline file",
+                        )
+    parser.add_argument("--save-baseline", dest="save_baseline",
+                        metavar='FILE',
+                        help="save the rates as a baseline",
+                        )
+    parser.add_argument("-t", "--threshold", type=float, default=0.2,
+                        help="fail if a rate is this fraction below the "
+                        "baseline (default: %(default)s)",
+                        )
+    parser.add_argument("--check", action='store_true', default=False,
+                        help="check the checksums of ckcdda and the numpy "
+                        "engine against a brute-force reference instead",
+                        )
+    parser.add_argument("--run", nargs=3, metavar=('STAGE', 'CORPUS',
+                                                   'ALBUM'),
+                        help=SUPPRESS)
+    utils.add_common_arguments(parser, VERSION)
+
+    options = parser.parse_args()
+    if options.scale <= 0:
+        parser.error('--scale must be positive')
+    if options.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return options
+
+def track_frames(seconds, scale, rng):
+    """Length of a track in frames, jittered by up to 25%"""
+    return max(int(seconds*75*scale*rng.uniform(0.75, 1.25)), 10)
+
+def write_track(path, num_samples):
+    with open(path, 'wb') as f:
+        utils.write_wav_header(f, num_samples)
+        left = num_samples*utils.BYTES_PER_SAMPLE
+        while left:
+            n = min(left, utils.BLOCK_SAMPLES*utils.BYTES_PER_SAMPLE)
+            f.write(os.urandom(n))
+            left -= n
+
+def album_paths(corpus, album):
+    d = join(corpus, album)
+    return sorted(join(d, f) for f in os.listdir(d) if f.endswith('.wav'))
+
+def album_tracks(corpus, album):
+    paths = album_paths(corpus, album)
+    counts = utils.probe_num_samples(arverify.BIN, paths)
+    return [arverify.Track(p, n) for p, n in zip(paths, counts)]
+
+def dbar_key(tracks):
+    cddb, id1, id2 = arverify.get_disc_ids(tracks)
+    return len(tracks), id1, id2, cddb
+
+def make_dbar(tracks, rng, verbose=False):
+    """dBAR file with DBAR_RESPONSES responses for tracks, the first of
+    which matches them if their checksums can be calculated here"""
+    engine = 'numpy' if arcf.numpy is not None else \
+        'ckcdda' if arverify.BIN['ckcdda'] else None
+    if engine:
+        # the checksum progress only shows with --verbose
+        quiet, utils.QUIET = utils.QUIET, utils.QUIET or not verbose
+        try:
+            arcfs, arcf450s, crc2s = arverify.scan_files(tracks, engine)
+        finally:
+            utils.QUIET = quiet
+        crcs = [(a[arcf.CHECK_RADIUS], b[arcf.CHECK_RADIUS])
+                for a, b in zip(arcfs, arcf450s)]
+    else:
+        crcs = [(rng.getrandbits(32), rng.getrandbits(32)) for t in tracks]
+
+    trackcount, id1, id2, cddb = dbar_key(tracks)
+    data = b''
+    for i in range(DBAR_RESPONSES):
+        data += struct.pack('<BIII', trackcount, id1, id2, cddb)
+        for crc, crc450 in crcs:
+            if i:
+                crc, crc450 = rng.getrandbits(32), rng.getrandbits(32)
+            data += struct.pack('<BII', rng.randint(1, 200), crc, crc450)
+    return data
+
+def generate_corpus(corpus, scale, seed, verbose=False):
+    """Write the corpus to corpus unless it's there already"""
+    spec = dict(version=CORPUS_VERSION, scale=scale, seed=seed,
+                albums=ALBUMS)
+    spec_path = join(corpus, 'corpus.json')
+    if exists(spec_path):
+        with open(spec_path) as f:
+            if json.load(f) == json.loads(json.dumps(spec)):
+                return
+    for album, lengths in ALBUMS:
+        if isdir(join(corpus, album)):
+            shutil.rmtree(join(corpus, album))
+    if isdir(join(corpus, 'cache')):
+        shutil.rmtree(join(corpus, 'cache'))
+
+    cache = arcache.Cache(join(corpus, 'cache'))
+    for i, (album, lengths) in enumerate(ALBUMS):
+        rng = random.Random('%i/%s' % (seed, album))
+        os.makedirs(join(corpus, album))
+        tracks = []
+        for n, seconds in enumerate(lengths, start=1):
+            utils.update_status('Generating corpus: %s (%i/%i)', album, n,
+                                len(lengths))
+            path = join(corpus, album, '%02i.wav' % n)
+            num_samples = track_frames(seconds, scale, rng)*588
+            write_track(path, num_samples)
+            tracks.append(arverify.Track(path, num_samples))
+        utils.finish_status()
+        cache.put(dbar_key(tracks), make_dbar(tracks, rng, verbose))
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+
+def bench_ckcdda(corpus, album):
+    """ckcdda alone, fed from memory mapped WAV files"""
+    tracks = album_tracks(corpus, album)
+    args = [arverify.BIN['ckcdda'], '-b'] + \
+        [str(t.num_sectors) for t in tracks]
+    with open(os.devnull, 'wb') as devnull:
+        p = Popen(args, stdin=PIPE, stdout=devnull)
+        PROCS.append(p)
+        start = time.time()
+        returncode = utils.write_blocks(p, arverify.decode_tracks(tracks))
+        seconds = time.time() - start
+    if returncode:
+        raise utils.SubprocessError('ckcdda had an error (returned %i)' %
+                                    returncode)
+    return seconds, sum(t.num_samples for t in tracks), 'samples'
+
+def bench_scan(corpus, album, engine, decode_jobs=1):
+    tracks = album_tracks(corpus, album)
+    arverify.DECODE_JOBS = decode_jobs
+    start = time.time()
+    arverify.scan_files(tracks, engine)
+    return time.time() - start, sum(t.num_samples for t in tracks), 'samples'
+
+def bench_disc_ids(corpus, album):
+    tracks = album_tracks(corpus, album)
+    start = time.time()
+    for i in range(DISC_ID_CALLS):
+        arverify.get_disc_ids(tracks, i % 150, 0)
+    return time.time() - start, DISC_ID_CALLS, 'calls'
+
+def bench_dbar_parse(corpus, album):
+    tracks = album_tracks(corpus, album)
+    trackcount, id1, id2, cddb = key = dbar_key(tracks)
+    with open(join(corpus, 'cache', arcache.filename(key)), 'rb') as f:
+        data = f.read()
+    start = time.time()
+    for i in range(DBAR_PARSES):
+        for t in tracks:
+            t.ar_entries = []
+        arverify.process_binary_ar_entries(data, cddb, id1, id2, tracks)
+    seconds = time.time() - start
+    return seconds, DBAR_PARSES*DBAR_RESPONSES*len(tracks), 'entries'
+
+def bench_fixoffset(corpus, album, fmt, jobs):
+    paths = album_paths(corpus, album)
+    sources = [dict(path=p, num_samples=n) for p, n in
+               zip(paths, utils.probe_num_samples(fixoffset.BIN, paths))]
+    start = time.time()
+    output_dir = fixoffset.fix_offset(sources, FIX_OFFSET, fmt, None, jobs)
+    seconds = time.time() - start
+    shutil.rmtree(output_dir)
+    return seconds, sum(s['num_samples'] for s in sources), 'samples'
+
+def bench_verify(corpus, album):
+    """arverify end to end, from interpreter start to summary"""
+    paths = album_paths(corpus, album)
+    args = [sys.executable, join(dirname(abspath(__file__)), 'arverify.py'),
+            '--offline', '--cache-dir', join(corpus, 'cache')] + paths
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        p = Popen(args, stdout=devnull, stderr=devnull)
+        PROCS.append(p)
+        p.wait()
+        seconds = time.time() - start
+    if p.returncode not in (0, 1):
+        raise utils.SubprocessError('arverify had an error (returned %i)' %
+                                    p.returncode)
+    samples = sum(utils.probe_num_samples(arverify.BIN, paths))
+    return seconds, samples, 'samples'
+
+def reference_checksums(samples, lengths, radius, offsets):
+    """Return {track: (arcfs, arcf450s, crc2)} calculated by brute force,
+    arcfs and arcf450s being {offset: checksum} for offsets
+
+    samples are the album's samples as uint32, lengths those of its tracks.
+    Every checksum is summed straight from its definition: the window of a
+    track is moved by the offset, with silence outside the album, and a
+    CRC450 is 0 unless its frame lies within the window.
+    """
+    padded = [0]*radius + list(samples) + [0]*radius
+    results = {}
+    start = 0
+    for t, length in enumerate(lengths):
+        lo = arcf.SKIP_FIRST if t == 0 else 0
+        hi = length - arcf.SKIP_LAST if t == len(lengths)-1 else length
+        weights = range(lo+1, hi+1)
+        crc2 = 0
+        for w, value in zip(weights, samples[start+lo:start+hi]):
+            product = w*value
+            crc2 += (product & arcf.MASK) + (product >> 32)
+        arcfs, arcf450s = {}, {}
+        for o in offsets:
+            a = start + lo + o + radius
+            arcfs[o] = sum(map(operator.mul, weights,
+                               padded[a:a+hi-lo])) & arcf.MASK
+            first = arcf.FRAME450 + o
+            if first + arcf.SAMPLES_PER_FRAME > hi:
+                arcf450s[o] = 0
+                continue
+            frame = [padded[start+p+radius] if p >= lo else 0 for p in
+                     range(first, first + arcf.SAMPLES_PER_FRAME)]
+            arcf450s[o] = sum(map(operator.mul,
+                                  range(1, arcf.SAMPLES_PER_FRAME+1),
+                                  frame)) & arcf.MASK
+        results[t] = arcfs, arcf450s, crc2 & arcf.MASK
+        start += length
+    return results
+
+def ckcdda_checksums(data, lengths, radius):
+    """Return [(arcfs, arcf450s, crc2)] of ckcdda -b for samples data"""
+    args = [arverify.BIN['ckcdda'], '-r', str(radius), '-b'] + \
+        [str(n // 588) for n in lengths]
+    p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    PROCS.append(p)
+    out, err = p.communicate(data)
+    if p.returncode:
+        raise utils.SubprocessError('ckcdda had an error (returned %i): %s'
+                                    % (p.returncode,
+                                       err.decode('utf-8', 'replace')))
+    row = array(arverify.UINT32)
+    row.frombytes(out)
+    if sys.byteorder == 'big':
+        row.byteswap()
+    n = 2*radius+1
+    size = 2*n+1
+    if len(row) != size*len(lengths):
+        raise utils.SubprocessError('ckcdda returned %i values, expected %i'
+                                    % (len(row), size*len(lengths)))
+    return [(row[i:i+n].tolist(), row[i+n:i+2*n].tolist(), row[i+2*n])
+            for i in range(0, len(row), size)]
+
+def numpy_checksums(data, lengths, radius):
+    engine = arcf.ARCFEngine(lengths, radius=radius)
+    engine.update(data)
+    arcfs, arcf450s, crc2s = engine.results()
+    return list(zip(arcfs.tolist(), arcf450s.tolist(), crc2s.tolist()))
+
+def run_checks(seed, verbose=False):
+    """Compare the engines with reference_checksums; return the number of
+    differences"""
+    engines = []
+    if arverify.BIN['ckcdda']:
+        engines.append(('ckcdda', ckcdda_checksums))
+    if arcf.numpy is not None:
+        engines.append(('numpy', numpy_checksums))
+    if not engines:
+        raise utils.DependencyError('ckcdda or numpy required\n')
+
+    failures = 0
+    for case, (radius, sectors) in enumerate(CHECK_CASES):
+        rng = random.Random('%i/check/%i' % (seed, case))
+        lengths = [n*588 for n in sectors]
+        samples = array(arverify.UINT32, (rng.getrandbits(32) for i in
+                                          range(sum(lengths))))
+        data = array(arverify.UINT32, samples)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        data = data.tobytes()
+        offsets = set([-radius, -radius+1, -1, 0, 1, radius-1, radius] +
+                      [rng.randint(-radius, radius)
+                       for i in range(CHECK_RANDOM_OFFSETS)])
+        offsets = sorted(o for o in offsets if -radius <= o <= radius)
+        expected = reference_checksums(samples, lengths, radius, offsets)
+
+        for name, checksums in engines:
+            differences = []
+            for t, (arcfs, arcf450s, crc2) in \
+                    enumerate(checksums(data, lengths, radius)):
+                ref_arcfs, ref_arcf450s, ref_crc2 = expected[t]
+                if crc2 != ref_crc2:
+                    differences.append('track %i CRCv2 %08X, expected %08X'
+                                       % (t, crc2, ref_crc2))
+                for o in offsets:
+                    for what, got, ref in (
+                            ('ARCF', arcfs[o+radius], ref_arcfs[o]),
+                            ('CRC450', arcf450s[o+radius], ref_arcf450s[o])):
+                        if got != ref:
+                            differences.append(
+                                'track %i offset %i %s %08X, expected %08X' %
+                                (t, o, what, got, ref))
+            print('%-7s radius %4i, tracks %s: %s' %
+                  (name, radius, sectors, 'ok' if not differences else
+                   '%i differences' % len(differences)))
+            for line in differences[:None if verbose else 5]:
+                print('    ' + line)
+            failures += len(differences)
+
+    for radius, sectors in CHECK_SHORT_CASES:
+        lengths = [n*588 for n in sectors]
+        data = b'\0'*(4*sum(lengths))
+        for name, checksums in engines:
+            try:
+                checksums(data, lengths, radius)
+            except (utils.SubprocessError, utils.NotFromCDError) as e:
+                result = 'rejected'
+                if verbose:
+                    result += ' (%s)' % str(e).strip()
+            else:
+                result = 'not rejected'
+                failures += 1
+            print('%-7s radius %4i, tracks %s: %s' %
+                  (name, radius, sectors, result))
+    return failures
+
+def stage_requirements(stage):
+    """Return why stage can't run here, or None"""
+    if 'ckcdda' in stage or stage in ('scan-parallel', 'verify'):
+        if not arverify.BIN['ckcdda']:
+            return 'ckcdda not found'
+    if stage == 'scan-numpy' and arcf.numpy is None:
+        return 'numpy not installed'
+    if stage == 'fixoffset-flac' and not fixoffset.BIN['splitaudio']:
+        return 'splitaudio not found'
+    return None
+
+def run_stage(stage, corpus, album, jobs):
+    """Child process: run one stage and print its measurements as JSON"""
+    utils.QUIET = True
+    if stage == 'ckcdda':
+        result = bench_ckcdda(corpus, album)
+    elif stage == 'scan-parallel':
+        result = bench_scan(corpus, album, 'ckcdda', jobs)
+    elif stage.startswith('scan-'):
+        result = bench_scan(corpus, album, stage[5:])
+    elif stage == 'disc-ids':
+        result = bench_disc_ids(corpus, album)
+    elif stage == 'dbar-parse':
+        result = bench_dbar_parse(corpus, album)
+    elif stage.startswith('fixoffset-'):
+        result = bench_fixoffset(corpus, album, stage[10:], jobs)
+    else:
+        result = bench_verify(corpus, album)
+
+    seconds, count, unit = result
+    maxrss = None
+    if resource:
+        maxrss = arprofile.maxrss_kib(max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+    print(json.dumps(dict(seconds=seconds, count=count, unit=unit,
+                          maxrss_kib=maxrss)))
+
+def measure(stage, corpus, album, options):
+    """Run stage in fresh processes; return the fastest measurement"""
+    best = None
+    for i in range(options.repeat):
+        args = [sys.executable, abspath(__file__), '--run', stage, corpus,
+                album, '--jobs', str(options.jobs)]
+        p = Popen(args, stdout=PIPE)
+        PROCS.append(p)
+        out, err = p.communicate()
+        if p.returncode:
+            raise utils.SubprocessError('%s on %s failed (returned %i)' %
+                                        (stage, album, p.returncode))
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            rss = [r for r in (result['maxrss_kib'],
+                               best and best['maxrss_kib']) if r]
+            result['maxrss_kib'] = max(rss) if rss else None
+            best = result
+    best['rate'] = best['count']/best['seconds'] if best['seconds'] else 0
+    return best
+
+def compare(name, rate, baseline, threshold):
+    """Return (change against baseline in %, whether it's a regression)"""
+    if not baseline.get(name):
+        return None, False
+    change = 100.0*(rate - baseline[name])/baseline[name]
+    return change, rate < baseline[name]*(1 - threshold)
+
+def main(options):
+    utils.check_dependencies(arverify.BIN, [])
+    utils.check_dependencies(fixoffset.BIN, [])
+    if options.run:
+        stage, corpus, album = options.run
+        run_stage(stage, corpus, album, options.jobs)
+        return 0
+    if options.check:
+        return 1 if run_checks(options.seed, options.verbose) else 0
+
+    corpus = options.corpus
+    tempdir = None
+    if not corpus:
+        corpus = tempdir = tempfile.mkdtemp(prefix='arbench')
+    try:
+        generate_corpus(corpus, options.scale, options.seed,
+                        options.verbose)
+        return run_benchmarks(abspath(corpus), options)
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+
+def run_benchmarks(corpus, options):
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    rates = {}
+    regressions = 0
+    fmt = '%-15s %-8s %9s %11s %-10s %8s %8s'
+    print(fmt % ('stage', 'album', 'seconds', 'rate', '', 'RSS MiB',
+                 'change'))
+    for stage in options.stage or STAGES:
+        missing = stage_requirements(stage)
+        if missing:
+            print('%-15s skipped: %s' % (stage, missing))
+            continue
+        for album, lengths in ALBUMS:
+            result = measure(stage, corpus, album, options)
+            name = '%s/%s' % (stage, album)
+            rates[name] = result['rate']
+            change, regressed = compare(name, result['rate'], baseline,
+                                        options.threshold)
+            regressions += regressed
+            print(fmt % (stage, album, '%.3f' % result['seconds'],
+                         '%.4g' % result['rate'], result['unit'] + '/s',
+                         '%.1f' % (result['maxrss_kib']/1024.0)
+                         if result['maxrss_kib'] else '-',
+                         '%+.1f%%' % change if change is not None else '-') +
+                  (' REGRESSION' if regressed else ''))
+            sys.stdout.flush()
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(rates, f, indent=2, sort_keys=True)
+    if regressions:
+        print('%i stage%s slower than the baseline by more than %i%%' %
+              (regressions, 's' if regressions != 1 else '',
+               options.threshold*100))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    utils.execute(main, process_arguments, PROCS)
@@ -0,0 +1,165 @@
+"""On-disk cache of accuraterip database responses
+
+Every response is stored verbatim in its own file, named like the dBAR
+file on the accuraterip server. Discs that aren't in the database are
+stored as empty files. The modification time of a file is the time it was
+downloaded and is checked against the TTL; the access time is set on every
+hit and decides which entries get evicted first once the cache grows past
+its size limit.
+"""
+from __future__ import print_function
+
+import os
+import time
+from tempfile import mkstemp
+from os.path import expanduser, join
+
+DEFAULT_TTL = 30*24*3600
+DEFAULT_SIZE = 64*1024*1024
+# rough cost of a directory entry, so that empty (negative) entries count
+ENTRY_OVERHEAD = 256
+# eviction makes this much of max_size free, so that it doesn't run again
+# on every put of a full cache
+EVICT_TO = 0.9
+
+def default_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or expanduser(join('~', '.cache'))
+    return join(base, 'cdrip-tools', 'dbar')
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", dest="cache_dir",
+                        default=default_dir(),
+                        help="directory for cached database responses "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--cache-ttl", dest="cache_ttl", type=int,
+                        default=DEFAULT_TTL,
+                        help="seconds before a cached response is fetched "
+                        "again (default: %(default)s)",
+                        )
+    parser.add_argument("--cache-size", dest="cache_size", type=int,
+                        default=DEFAULT_SIZE,
+                        help="maximum size of the cache in bytes "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--no-cache", dest="cache", action='store_false',
+                        default=True,
+                        help="don't cache database responses",
+                        )
+    parser.add_argument("--offline", action='store_true',
+                        default=False,
+                        help="only use cached database responses",
+                        )
+
+def from_options(options):
+    """Return the Cache selected by options, or None"""
+    if not options.cache:
+        return None
+    return Cache(options.cache_dir, options.cache_ttl, options.cache_size,
+                 options.offline)
+
+def filename(key):
+    """key is (track count, id1, id2, cddb)"""
+    return 'dBAR-%03d-%08x-%08x-%08x.bin' % key
+
+class Cache(object):
+    """Cache of raw dBAR responses keyed by (track count, id1, id2, cddb)"""
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_SIZE,
+                 offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        # running total of the entry sizes, read from the directory on the
+        # first put; other processes' writes are picked up by evict
+        self.size = None
+
+    def get(self, key):
+        """Return the cached response for key, or None
+
+        An empty string means the disc isn't in the database. Expired
+        entries are still returned in offline mode.
+        """
+        path = join(self.path, filename(key))
+        try:
+            st = os.stat(path)
+            now = time.time()
+            if not self.offline and now - st.st_mtime > self.ttl:
+                raise OSError
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (now, st.st_mtime))
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def has(self, key):
+        """Whether key is cached and current, without counting a hit"""
+        try:
+            st = os.stat(join(self.path, filename(key)))
+        except OSError:
+            return False
+        return self.offline or time.time() - st.st_mtime <= self.ttl
+
+    def put(self, key, data):
+        path = join(self.path, filename(key))
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if self.size is None:
+                self.size = sum(entry[1] for entry in self.entries())
+            try:
+                replaced = os.stat(path).st_size + ENTRY_OVERHEAD
+            except OSError:
+                replaced = 0
+            fd, tmp = mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # the cache is just an optimization
+            return
+        self.size += len(data) + ENTRY_OVERHEAD - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """Return (atime, size, name) of every entry"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.startswith('dBAR-'):
+                continue
+            try:
+                st = os.stat(join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size+ENTRY_OVERHEAD, name))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until under max_size (or,
+        once it's exceeded, under EVICT_TO of it)"""
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        limit = self.max_size*EVICT_TO if size > self.max_size \
+            else self.max_size
+        entries.sort()
+        for atime, entry_size, name in entries:
+            if size <= limit:
+                break
+            try:
+                os.unlink(join(self.path, name))
+            except OSError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def summary(self):
+        return 'dBAR cache: %i hit%s, %i miss%s' % \
+            (self.hits, 's' if self.hits != 1 else '',
+             self.misses, 'es' if self.misses != 1 else '')
@@ -0,0 +1,243 @@
+"""In-process AccurateRip checksum calculation
+
+NumPy port of ckcdda.c. Rather than updating every derived ARCF one sample
+at a time, each track keeps two running sums over its base window plus copies
+of the samples around its window edges and around frame 450. Once the stream
+is finished, the ARCFs for all offsets are recovered from those with prefix
+sums. All arithmetic is done modulo 2**32, so the results are bit-identical
+to the ones ckcdda prints.
+"""
+from __future__ import print_function, division
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils import DependencyError, NotFromCDError, SAMPLES_PER_FRAME
+
+CHECK_RADIUS = 5*SAMPLES_PER_FRAME-1
+ARCFS_PER_TRACK = 2*CHECK_RADIUS+1
+MAX_RADIUS = 450*SAMPLES_PER_FRAME
+
+# samples skipped at the start of the first and the end of the last track
+SKIP_FIRST = 5*SAMPLES_PER_FRAME-1
+SKIP_LAST = 5*SAMPLES_PER_FRAME
+FRAME450 = 450*SAMPLES_PER_FRAME
+
+MASK = 0xFFFFFFFF
+
+def check_numpy():
+    if numpy is None:
+        raise DependencyError("numpy required\n")
+
+def frame450_crcs(frame, hi, radius=CHECK_RADIUS):
+    """CRC450s for offsets -radius to +radius without numpy
+
+    frame holds the SAMPLES_PER_FRAME+2*radius samples of a track from
+    FRAME450-radius on, hi is the end of the track's checksum window.
+    Offsets whose frame is not completely inside it are 0.
+    """
+    n = SAMPLES_PER_FRAME
+    p0 = [0]
+    p1 = [0]
+    for q, y in enumerate(frame):
+        p0.append(p0[-1] + y)
+        p1.append(p1[-1] + q*y)
+
+    crcs = []
+    for j in range(2*radius+1):
+        first = FRAME450 + j - radius
+        if first < 0 or first+n > hi:
+            crcs.append(0)
+            continue
+        d0 = p0[j+n] - p0[j]
+        crcs.append((p1[j+n] - p1[j] + d0 - j*d0) & MASK)
+    return crcs
+
+def _clip(lo, hi, start, end):
+    return max(lo, start), min(hi, end)
+
+class TrackState(object):
+    """Running state for the checksums of one track
+
+    Positions are absolute sample indices into the album stream. The window
+    of the track at offset -radius is [base_start, base_end); the window at
+    offset +radius ends radius*2 samples later.
+    """
+    def __init__(self, start, length, first, last, radius=CHECK_RADIUS):
+        self.radius = radius
+        self.lo = SKIP_FIRST if first else 0
+        self.hi = length - SKIP_LAST if last else length
+
+        self.base_start = start + self.lo - radius
+        self.base_end = start + self.hi - radius
+        self.crc2_start = start + self.lo
+        self.crc2_end = start + self.hi
+        self.frame_start = start + FRAME450 - radius
+        self.end = max(self.base_end, self.frame_start) + \
+            SAMPLES_PER_FRAME + 2*radius
+
+        self.sum = 0           # sum of samples in base window
+        self.weighted_sum = 0  # base ARCF (offset -radius)
+        self.crc2 = 0
+        self.head = numpy.zeros(2*radius, dtype=numpy.uint32)
+        self.tail = numpy.zeros(2*radius, dtype=numpy.uint32)
+        self.frame = numpy.zeros(SAMPLES_PER_FRAME+2*radius,
+                                 dtype=numpy.uint32)
+
+    def update(self, samples, start):
+        end = start + len(samples)
+
+        a, b = _clip(self.base_start, self.base_end, start, end)
+        if a < b:
+            x = samples[a-start:b-start].astype(numpy.uint64)
+            w = numpy.arange(a-self.base_start+self.lo+1,
+                             b-self.base_start+self.lo+1, dtype=numpy.uint64)
+            self.sum = (self.sum + int(x.sum())) & MASK
+            self.weighted_sum = (self.weighted_sum + int((w*x).sum())) & MASK
+
+        a, b = _clip(self.crc2_start, self.crc2_end, start, end)
+        if a < b:
+            x = samples[a-start:b-start].astype(numpy.uint64)
+            w = numpy.arange(a-self.crc2_start+self.lo+1,
+                             b-self.crc2_start+self.lo+1, dtype=numpy.uint64)
+            m = w*x
+            self.crc2 = (self.crc2 + int((m & MASK).sum()) +
+                         int((m >> 32).sum())) & MASK
+
+        for buf, buf_start in ((self.head, self.base_start),
+                               (self.tail, self.base_end),
+                               (self.frame, self.frame_start)):
+            a, b = _clip(buf_start, buf_start+len(buf), start, end)
+            if a < b:
+                buf[a-buf_start:b-buf_start] = samples[a-start:b-start]
+
+    def merge(self, other):
+        """Add the state of other, which saw a disjoint part of the stream"""
+        self.sum = (self.sum + other.sum) & MASK
+        self.weighted_sum = (self.weighted_sum + other.weighted_sum) & MASK
+        self.crc2 = (self.crc2 + other.crc2) & MASK
+        self.head += other.head
+        self.tail += other.tail
+        self.frame += other.frame
+
+    def arcfs(self):
+        """ARCFs for offsets -radius to +radius
+
+        Moving the window j samples to the right drops the first j samples
+        of head and adds the first j samples of tail, and lowers the weight
+        of every sample in the window by j.
+        """
+        r = self.radius
+        m = numpy.arange(2*r, dtype=numpy.uint64)
+        head = self.head.astype(numpy.uint64)
+        tail = self.tail.astype(numpy.uint64)
+        zero = numpy.zeros(1, dtype=numpy.uint64)
+        head0 = numpy.concatenate((zero, numpy.cumsum(head)))
+        tail0 = numpy.concatenate((zero, numpy.cumsum(tail)))
+        head1 = numpy.concatenate((zero, numpy.cumsum((m+self.lo+1)*head)))
+        tail1 = numpy.concatenate((zero, numpy.cumsum((m+self.hi+1)*tail)))
+
+        j = numpy.arange(2*r+1, dtype=numpy.uint64)
+        sum0 = numpy.uint64(self.sum) - head0 + tail0
+        sum1 = numpy.uint64(self.weighted_sum) - head1 + tail1
+        return ((sum1 - j*sum0) & MASK).astype(numpy.uint32)
+
+    def arcf450s(self):
+        """CRCs of frame 450 for offsets -radius to +radius
+
+        Offsets whose frame is not completely inside the track are 0.
+        """
+        r = self.radius
+        n = SAMPLES_PER_FRAME
+        y = self.frame.astype(numpy.uint64)
+        q = numpy.arange(len(y), dtype=numpy.uint64)
+        zero = numpy.zeros(1, dtype=numpy.uint64)
+        p0 = numpy.concatenate((zero, numpy.cumsum(y)))
+        p1 = numpy.concatenate((zero, numpy.cumsum(q*y)))
+
+        j = numpy.arange(2*r+1)
+        d0 = p0[j+n] - p0[j]
+        d1 = p1[j+n] - p1[j]
+        crc450 = (d1 + d0 - j.astype(numpy.uint64)*d0) & MASK
+
+        first = FRAME450 + j - r
+        crc450[(first < 0) | (first+n > self.hi)] = 0
+        return crc450.astype(numpy.uint32)
+
+class ARCFEngine(object):
+    """Calculates CRCv1, CRCv2 and CRC450 of every track for all offsets
+
+    Feed the album as little-endian 32 bit stereo samples with update().
+    Passing position makes the engine start at that sample of the album,
+    which together with states() and merge() allows separate engines to
+    cover separate parts of the stream.
+    """
+    def __init__(self, lengths, position=0, radius=CHECK_RADIUS):
+        check_numpy()
+        # like ckcdda, every window must hold the 2*radius samples kept
+        # around its edges
+        for i, length in enumerate(lengths):
+            if length - (SKIP_FIRST if i == 0 else 0) - \
+                    (SKIP_LAST if i == len(lengths)-1 else 0) < 2*radius:
+                raise NotFromCDError('Track %i too short for radius %i\n' %
+                                     (i, radius))
+        self.lengths = lengths
+        self.total = sum(lengths)
+        self.position = position
+        self.radius = radius
+        self.touched = set()
+        self.reported = 0
+        self.tracks = []
+        start = 0
+        for i, length in enumerate(lengths):
+            self.tracks.append(TrackState(start, length, i == 0,
+                                          i == len(lengths)-1, radius))
+            start += length
+
+    def update(self, data):
+        samples = numpy.frombuffer(data, dtype='<u4')
+        start = self.position
+        end = start + len(samples)
+        for i, track in enumerate(self.tracks):
+            if track.base_start < end and track.end > start:
+                track.update(samples, start)
+                self.touched.add(i)
+        self.position = end
+
+    def states(self):
+        """Return the track states this engine has seen samples for"""
+        return dict((i, self.tracks[i]) for i in self.touched)
+
+    def merge(self, states):
+        """Merge states returned by another engine's states()"""
+        for i, state in states.items():
+            self.tracks[i].merge(state)
+            self.touched.add(i)
+
+    def finished(self, final=False):
+        """Yield (index, arcfs, arcf450s, crc2) of every track the stream has
+        moved past since the last call, in track order
+
+        The windows of the last track reach beyond the end of the album, so
+        pass final once all samples have been fed.
+        """
+        while self.reported < len(self.tracks):
+            track = self.tracks[self.reported]
+            if track.end > self.position and not final:
+                break
+            yield (self.reported, track.arcfs(), track.arcf450s(),
+                   int(track.crc2))
+            self.reported += 1
+
+    def results(self):
+        """Return (arcfs, arcf450s, crc2s)
+
+        arcfs and arcf450s have one row per track and one column per offset,
+        column radius being offset 0.
+        """
+        arcfs = numpy.array([t.arcfs() for t in self.tracks])
+        arcf450s = numpy.array([t.arcf450s() for t in self.tracks])
+        crc2s = numpy.array([t.crc2 for t in self.tracks], dtype=numpy.uint32)
+        return arcfs, arcf450s, crc2s
@@ -0,0 +1,199 @@
+"""HTTP client for the accuraterip database
+
+A Client keeps the persistent connections to the server it has opened in
+a pool shared by all threads of the process: a lookup takes an idle one
+(or opens one) and hands it back when it's done. So concurrent lookups
+(disc ID searches, prefetching a whole batch) and lookups from short-lived
+threads (one per disc in arbatch and arwatch workers) reuse connections
+instead of opening one per dBAR file. Requests time out, and
+failed ones are retried with exponential backoff before giving up with a
+NetworkError.
+"""
+from __future__ import print_function
+
+import os
+import time
+import socket
+import threading
+from argparse import ArgumentTypeError
+from multiprocessing.pool import ThreadPool
+try:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+
+import arcache
+from utils import NetworkError
+
+DEFAULT_URL = 'http://www.accuraterip.com'
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+DEFAULT_JOBS = 8
+BACKOFF = 0.5
+
+def server_url(value):
+    parts = urlsplit(value)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ArgumentTypeError('%s is not an http(s) URL' % value)
+
+    return value
+
+def add_client_arguments(parser):
+    parser.add_argument("--server", default=DEFAULT_URL, type=server_url,
+                        help="accuraterip database to use "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds to wait for the database "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="times to retry a failed lookup "
+                        "(default: %(default)s)",
+                        )
+
+def check_client_options(parser, options):
+    if options.timeout <= 0:
+        parser.error('--timeout must be positive')
+    if options.retries < 0:
+        parser.error('--retries must be at least 0')
+
+def from_options(options):
+    return Client(options.server, options.timeout, options.retries)
+
+def dbar_path(key):
+    """Path of the dBAR file for key (track count, id1, id2, cddb)"""
+    trackcount, id1, id2, cddb = key
+    return '/accuraterip/%.1x/%.1x/%.1x/%s' % \
+        (id1 & 0xF, id1>>4 & 0xF, id1>>8 & 0xF, arcache.filename(key))
+
+class Client(object):
+    """Fetches dBAR files over a pool of keep-alive connections
+
+    At most max_idle connections are kept open between lookups; close()
+    closes them. A Client copied into another process (by pickling or by
+    fork) starts with no connections.
+    """
+    def __init__(self, url=DEFAULT_URL, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, max_idle=DEFAULT_JOBS):
+        self.base = url.rstrip('/')
+        parts = urlsplit(self.base)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path
+        self.timeout = timeout
+        self.retries = retries
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['idle'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def url(self, key):
+        return self.base + dbar_path(key)
+
+    def acquire(self):
+        """Take an idle connection from the pool, or open a new one"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # the sockets belong to the parent process
+                self.idle = []
+                self.pid = os.getpid()
+            if self.idle:
+                return self.idle.pop()
+        cls = HTTPSConnection if self.https else HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn):
+        """Hand conn back to the pool after a complete response"""
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections"""
+        with self.lock:
+            idle = self.idle if self.pid == os.getpid() else []
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+    def fetch(self, key):
+        """Return the dBAR file for key, or an empty string if there's none
+
+        Connection errors, timeouts and 5xx responses are retried.
+        """
+        delay = BACKOFF
+        for attempt in range(self.retries+1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            conn = self.acquire()
+            try:
+                conn.request('GET', self.prefix + dbar_path(key))
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, HTTPException) as e:
+                error = str(e) or e.__class__.__name__
+                conn.close()
+                continue
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(conn)
+
+            if response.status == 404:
+                return b''
+            if response.status == 200:
+                if b'html' in data and b'404' in data:
+                    data = b''
+                return data
+            error = 'HTTP %i' % response.status
+            if response.status < 500:
+                break
+
+        raise NetworkError("Could not connect to accuraterip database (%s)" %
+                           error)
+
+def prefetch(client, cache, keys, jobs=DEFAULT_JOBS):
+    """Fetch the dBAR files for keys that aren't in cache yet into it,
+    jobs at a time; returns the number of files fetched
+
+    Lookups that fail are skipped, they are retried when they're needed.
+    """
+    def job(key):
+        try:
+            return key, client.fetch(key)
+        except NetworkError:
+            return key, None
+
+    missing = [k for k in set(keys) if not cache.has(k)]
+    if not missing:
+        return 0
+    fetched = 0
+    pool = ThreadPool(min(jobs, len(missing)))
+    try:
+        for key, data in pool.imap_unordered(job, missing):
+            if data is not None:
+                cache.put(key, data)
+                fetched += 1
+    finally:
+        pool.terminate()
+    return fetched
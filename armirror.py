@@ -0,0 +1,283 @@
+#!/usr/bin/python
+"""Local mirror of the accuraterip database in one indexed file
+
+The file holds any number of dBAR responses, verbatim as the server sends
+them and as process_binary_ar_entries parses them. A response of length 0
+means the disc isn't in the database. Layout, little endian:
+
+    header  magic 'ARMIRROR', version (uint32), number of entries (uint32)
+    index   one entry per disc sorted by key: track count, id1, id2, cddb
+            (uint32 each), offset (uint64) and length (uint32) of the
+            response
+    data    the responses
+
+The file is memory mapped and a lookup is a binary search over the index,
+so opening a mirror costs nothing however many discs it holds. Mirrors are
+rewritten to a temporary file and renamed, so processes that have one open
+keep working while it's updated.
+"""
+from __future__ import print_function
+
+import os
+import re
+import sys
+import mmap
+import struct
+from argparse import ArgumentParser
+from tempfile import mkstemp
+from os.path import abspath, basename, dirname, isdir, join
+
+import utils
+from utils import MirrorError
+
+PROGNAME = 'armirror'
+VERSION = '0.2'
+PROCS = []
+
+MAGIC = b'ARMIRROR'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')
+INDEX = struct.Struct('<IIIIQI')
+KEY = struct.Struct('<IIII')
+LOCATION = struct.Struct('<QI')
+CHUNK_HEADER = struct.Struct('<BIII')
+ENTRY_SIZE = 9
+FILENAME_RE = re.compile(r'^dBAR-(\d{3})-([0-9a-f]{8})-([0-9a-f]{8})-'
+                         r'([0-9a-f]{8})\.bin$')
+
+def add_mirror_arguments(parser):
+    parser.add_argument("--mirror", type=utils.isfile, metavar='FILE',
+                        help="look up discs in this local mirror of the "
+                        "database (made with armirror.py) before the cache "
+                        "and the server",
+                        )
+
+def from_options(options):
+    """Return the Mirror selected by options, or None"""
+    if not options.mirror:
+        return None
+    return Mirror(options.mirror)
+
+def parse_filename(name):
+    """Key (track count, id1, id2, cddb) of a dBAR file name, or None"""
+    m = FILENAME_RE.match(basename(name))
+    if not m:
+        return None
+    return (int(m.group(1)),) + tuple(int(x, 16) for x in m.groups()[1:])
+
+def check_response(key, data):
+    """Whether data is a well-formed dBAR response for key"""
+    trackcount = key[0]
+    size = CHUNK_HEADER.size + trackcount*ENTRY_SIZE
+    if len(data) % size:
+        return False
+    for offset in range(0, len(data), size):
+        if CHUNK_HEADER.unpack_from(data, offset) != key:
+            return False
+    return True
+
+class Mirror(object):
+    """Read-only view of a mirror file
+
+    The file is mapped on first use, so a Mirror can be handed to worker
+    processes before it is used.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._map = None
+        self.count = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_map'] = None
+        return state
+
+    @property
+    def map(self):
+        if self._map is None:
+            self._open()
+        return self._map
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                raise MirrorError('%s is not a mirror' % self.path)
+        if len(m) < HEADER.size:
+            raise MirrorError('%s is not a mirror' % self.path)
+        magic, version, count = HEADER.unpack_from(m, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or \
+                len(m) < HEADER.size + count*INDEX.size:
+            raise MirrorError('%s is not a mirror (version %i)' %
+                              (self.path, FORMAT_VERSION))
+        self.count = count
+        self._map = m
+
+    def key(self, i):
+        return KEY.unpack_from(self.map, HEADER.size + i*INDEX.size)
+
+    def location(self, i):
+        """(offset, length) of the response of entry i"""
+        return LOCATION.unpack_from(self.map, HEADER.size + i*INDEX.size +
+                                    KEY.size)
+
+    def find(self, key):
+        """Index of key, or None"""
+        m = self.map
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(m, HEADER.size + mid*INDEX.size) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.key(lo) == key:
+            return lo
+        return None
+
+    def get(self, key):
+        """Return the response for key, or None if it isn't mirrored
+
+        An empty string means the disc isn't in the database.
+        """
+        i = self.find(tuple(key))
+        if i is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        offset, length = self.location(i)
+        return self.map[offset:offset+length]
+
+    def __len__(self):
+        if self._map is None:
+            self._open()
+        return self.count
+
+    def summary(self):
+        return 'dBAR mirror: %i hit%s, %i miss%s' % \
+            (self.hits, 's' if self.hits != 1 else '',
+             self.misses, 'es' if self.misses != 1 else '')
+
+def write_mirror(path, sources):
+    """Write a mirror of sources, {key: function returning the response},
+    to path"""
+    keys = sorted(sources)
+    fd, tmp = mkstemp(dir=dirname(abspath(path)), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(keys)))
+            f.seek(HEADER.size + len(keys)*INDEX.size)
+            index = []
+            for key in keys:
+                data = sources[key]()
+                index.append(INDEX.pack(*(key + (f.tell(), len(data)))))
+                f.write(data)
+            f.seek(HEADER.size)
+            f.write(b''.join(index))
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def read_file(path):
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+    return read
+
+def mirror_entry(mirror, i):
+    def read():
+        offset, length = mirror.location(i)
+        return mirror.map[offset:offset+length]
+    return read
+
+def find_dbar_files(paths):
+    """Yield (key, path) of the dBAR files among paths and below the
+    directories among them"""
+    for path in paths:
+        if isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    key = parse_filename(name)
+                    if key:
+                        yield key, join(dirpath, name)
+        else:
+            key = parse_filename(path)
+            if key:
+                yield key, path
+            else:
+                print('%s: not a dBAR file name, skipped' % path,
+                      file=sys.stderr)
+
+def process_arguments():
+    parser = \
+        ArgumentParser(description='Maintain a local mirror of the '
+                       'accuraterip database.', prog=PROGNAME)
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('import', help='add dBAR files (like the ones '
+                            'in the cache directory) to a mirror')
+    p.add_argument('mirror', help='mirror file, created if missing')
+    p.add_argument('paths', metavar='path', nargs='+',
+                   help='dBAR file or directory tree of them')
+    p = commands.add_parser('merge', help='add the entries of other mirrors '
+                            'to a mirror')
+    p.add_argument('mirror', help='mirror file, created if missing')
+    p.add_argument('others', metavar='other', nargs='+', type=utils.isfile,
+                   help='mirror file; entries of later ones win')
+    p = commands.add_parser('info', help='show the size of a mirror')
+    p.add_argument('mirror', type=utils.isfile, help='mirror file')
+    utils.add_common_arguments(parser, VERSION)
+
+    options = parser.parse_args()
+    if not options.command:
+        parser.error('no command given')
+
+    return options
+
+def main(options):
+    sources = {}
+    if options.command != 'info' and os.path.exists(options.mirror):
+        existing = Mirror(options.mirror)
+        for i in range(len(existing)):
+            sources[existing.key(i)] = mirror_entry(existing, i)
+
+    if options.command == 'info':
+        mirror = Mirror(options.mirror)
+        present = sum(1 for i in range(len(mirror))
+                      if mirror.location(i)[1])
+        print('%s: %i discs (%i in the database, %i not), %i bytes' %
+              (options.mirror, len(mirror), present, len(mirror) - present,
+               os.path.getsize(options.mirror)))
+        return 0
+
+    before = len(sources)
+    skipped = 0
+    if options.command == 'import':
+        for key, path in find_dbar_files(options.paths):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if not check_response(key, data):
+                print('%s: malformed response, skipped' % path,
+                      file=sys.stderr)
+                skipped += 1
+                continue
+            sources[key] = read_file(path)
+    else:
+        for path in options.others:
+            other = Mirror(path)
+            for i in range(len(other)):
+                sources[other.key(i)] = mirror_entry(other, i)
+
+    write_mirror(options.mirror, sources)
+    print('%s: %i discs, %i new%s' % (options.mirror, len(sources),
+                                      len(sources) - before,
+                                      ', %i skipped' % skipped
+                                      if skipped else ''))
+    return 0
+
+if __name__ == '__main__':
+    utils.execute(main, process_arguments, PROCS)
@@ -0,0 +1,150 @@
+"""Per-stage timing and resource report (--profile)
+
+While profiling, utils.PROFILE is a Profiler. Stages (probing, the
+database lookup, decoding, piping into ckcdda/splitaudio, parsing its
+output, matching) add their wall time with utils.profile_stage and
+utils.profile_blocks. Every child process waited for with
+utils.wait_process is reaped with os.wait4, which gives its CPU time and
+peak memory, and the bytes piped into and out of it are counted.
+
+Stages running in different threads overlap, so their times can add up to
+more than the total wall time. cProfile only sees the main thread.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import errno
+import cProfile
+import threading
+from os.path import basename
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import utils
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action='store_true', default=False,
+                        help="write a JSON report of the time spent in every "
+                        "stage and the resources used by every subprocess "
+                        "after the summary",
+                        )
+    parser.add_argument("--profile-output", dest="profile_output",
+                        metavar='FILE',
+                        help="write the --profile report to FILE instead "
+                        "(implies --profile)",
+                        )
+    parser.add_argument("--profile-python", dest="profile_python",
+                        metavar='FILE',
+                        help="also write cProfile statistics of the Python "
+                        "side to FILE (implies --profile)",
+                        )
+
+def maxrss_kib(ru_maxrss):
+    # bytes on macOS, KiB elsewhere
+    return ru_maxrss // 1024 if sys.platform == 'darwin' else ru_maxrss
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class Profiler(object):
+    """Collects stage times and subprocess resources for one run"""
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, nbytes=0):
+        with self.lock:
+            s = self.stages.setdefault(stage, dict(seconds=0.0, calls=0,
+                                                   bytes=0))
+            s['seconds'] += seconds
+            s['calls'] += 1
+            s['bytes'] += nbytes
+
+    def process(self, p):
+        """Record of p, created on first use"""
+        with self.lock:
+            if id(p) not in self.processes:
+                args = getattr(p, 'args', None)
+                name = args[0] if isinstance(args, list) else args
+                self.processes[id(p)] = dict(
+                    program=basename(name) if name else None, pid=p.pid,
+                    returncode=None, user=None, system=None, maxrss_kib=None,
+                    stdin_bytes=0, stdout_bytes=0)
+            return self.processes[id(p)]
+
+    def piped(self, p, nbytes, stdout=False):
+        record = self.process(p)
+        with self.lock:
+            record['stdout_bytes' if stdout else 'stdin_bytes'] += nbytes
+
+    def wait(self, p):
+        """Wait for p with os.wait4 and record its resource usage"""
+        record = self.process(p)
+        if p.returncode is None and hasattr(os, 'wait4'):
+            try:
+                pid, status, usage = os.wait4(p.pid, 0)
+            except OSError as e:
+                # reaped by someone else (Popen.poll in another thread)
+                if e.errno != errno.ECHILD:
+                    raise
+            else:
+                p.returncode = exit_code(status)
+                record.update(user=usage.ru_utime, system=usage.ru_stime,
+                              maxrss_kib=maxrss_kib(usage.ru_maxrss))
+        returncode = p.wait()
+        record['returncode'] = returncode
+        return returncode
+
+    def report(self, prog, cprofile=None):
+        report = dict(program=prog, wall=time.time() - self.started,
+                      stages=self.stages,
+                      processes=sorted(self.processes.values(),
+                                       key=lambda r: r['pid']),
+                      cprofile=cprofile)
+        if resource:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            report['python'] = dict(user=usage.ru_utime,
+                                    system=usage.ru_stime,
+                                    maxrss_kib=maxrss_kib(usage.ru_maxrss))
+        return report
+
+def write_report(report, path):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+
+def profiled(main, prog):
+    """Wrap main so that it's profiled when --profile, --profile-output or
+    --profile-python is given; the report is written even if main fails"""
+    def run(options):
+        path = options.profile_output or \
+            ('-' if options.profile or options.profile_python else None)
+        if not path:
+            return main(options)
+
+        utils.PROFILE = Profiler()
+        profile = cProfile.Profile() if options.profile_python else None
+        try:
+            if profile:
+                return profile.runcall(main, options)
+            return main(options)
+        finally:
+            if profile:
+                profile.dump_stats(options.profile_python)
+            write_report(utils.PROFILE.report(prog, options.profile_python),
+                         path)
+            utils.PROFILE = None
+    return run
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""Local stand-in for the accuraterip database
+
+Serves the dBAR-*.bin files found below a directory (a dBAR cache
+directory works) under the same paths as www.accuraterip.com, so lookups
+can be exercised offline with --server http://127.0.0.1:PORT. Delays and
+failures can be injected to check timeouts and retries.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import threading
+from argparse import ArgumentParser
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import utils
+
+PROGNAME = 'arserver'
+VERSION = '0.2'
+PROCS = []
+
+def process_arguments():
+    parser = \
+        ArgumentParser(description='Serve dBAR files like the accuraterip '
+                       'database.', prog=PROGNAME)
+    parser.add_argument('dir', type=utils.isdir,
+                        help='directory tree with dBAR-*.bin files')
+    parser.add_argument("-p", "--port", type=int, default=8080,
+                        help="port to listen on (default: %(default)s)",
+                        )
+    parser.add_argument("--host", default='127.0.0.1',
+                        help="address to listen on (default: %(default)s)",
+                        )
+    parser.add_argument("--delay", type=float, default=0,
+                        help="seconds to wait before every response",
+                        )
+    parser.add_argument("--fail-rate", dest="fail_rate", type=float,
+                        default=0,
+                        help="fraction of requests answered with 503",
+                        )
+    parser.add_argument("--drop-rate", dest="drop_rate", type=float,
+                        default=0,
+                        help="fraction of requests whose connection is "
+                        "closed without an answer",
+                        )
+    utils.add_common_arguments(parser, VERSION)
+
+    return parser.parse_args()
+
+def find_files(top):
+    """Return {filename: path} of the dBAR files below top"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        for f in filenames:
+            if f.startswith('dBAR-') and f.endswith('.bin'):
+                files[f] = os.path.join(dirpath, f)
+    return files
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+
+    def do_GET(self):
+        server = self.server
+        with self.lock:
+            server.requests += 1
+        if server.options.delay:
+            time.sleep(server.options.delay)
+        if random.random() < server.options.drop_rate:
+            self.close_connection = True
+            return
+        if random.random() < server.options.fail_rate:
+            return self.respond(503, b'')
+
+        path = server.files.get(self.path.rsplit('/', 1)[-1])
+        if path is None:
+            return self.respond(404, b'')
+        with open(path, 'rb') as f:
+            self.respond(200, f.read())
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if self.server.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+def main(options):
+    server = Server((options.host, options.port), Handler)
+    server.options = options
+    server.files = find_files(options.dir)
+    server.requests = 0
+    print('Serving %i dBAR files on http://%s:%i' %
+          (len(server.files), options.host, server.server_address[1]),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        print('%i requests' % server.requests, file=sys.stderr)
+        server.server_close()
+
+    return 0
+
+if __name__ == '__main__':
+    utils.execute(main, process_arguments, PROCS)
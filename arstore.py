@@ -0,0 +1,181 @@
+"""Persistent store of computed checksums
+
+Decoding is by far the most expensive part of a verification, but the
+checksums of a file only change when the file does. The store keeps the
+scan_files tables (CRCv1 and CRC450 for every offset, CRCv2) of every album
+in an SQLite database, so an unchanged album only has to be matched against
+the database response again.
+
+Albums are keyed by the identity of their files and the offset radius. By
+default a file is identified by its path, size and modification time. With
+hashing enabled it is identified by its size and a hash of its first and
+last blocks instead, so entries still match after the library has been
+moved or copied.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from array import array
+from os.path import abspath, dirname, join
+
+import arcache
+
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+HASH_BLOCK = 64*1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    key TEXT PRIMARY KEY,
+    radius INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    key TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    crc1 INTEGER NOT NULL,
+    crc2 INTEGER NOT NULL,
+    crc450 INTEGER NOT NULL,
+    arcfs BLOB NOT NULL,
+    arcf450s BLOB NOT NULL,
+    PRIMARY KEY (key, number)
+);
+"""
+
+def default_path():
+    return join(dirname(arcache.default_dir()), 'checksums.sqlite')
+
+def add_store_arguments(parser):
+    parser.add_argument("--store", action='store_true', default=False,
+                        help="keep computed checksums in a database and "
+                        "skip decoding unchanged albums",
+                        )
+    parser.add_argument("--store-db", dest="store_db", metavar='DB',
+                        help="database of --store (implies --store; "
+                        "default: %s)" % default_path(),
+                        )
+    parser.add_argument("--store-hash", dest="store_hash",
+                        action='store_true', default=False,
+                        help="identify files in the store by a hash of "
+                        "their contents instead of path and mtime",
+                        )
+
+def from_options(options):
+    """Return the Store selected by options, or None"""
+    if not options.store and not options.store_db:
+        return None
+    return Store(options.store_db or default_path(), options.store_hash)
+
+def pack(values):
+    return array(UINT32, values).tobytes()
+
+def unpack(blob):
+    a = array(UINT32)
+    a.frombytes(blob)
+    return a.tolist()
+
+def file_hash(path, size):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read(HASH_BLOCK))
+        if size > HASH_BLOCK:
+            f.seek(max(HASH_BLOCK, size-HASH_BLOCK))
+            h.update(f.read(HASH_BLOCK))
+    return h.hexdigest()
+
+class Store(object):
+    """SQLite database of scan_files results keyed by album identity
+
+    The connection is opened on first use, so a Store can be handed to
+    worker processes before it is used.
+    """
+    def __init__(self, path, hash_files=False):
+        self.path = path
+        self.hash_files = hash_files
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._keys = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            if dirname(self.path) and not os.path.isdir(dirname(self.path)):
+                os.makedirs(dirname(self.path))
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_keys'] = {}
+        return state
+
+    def file_id(self, path):
+        st = os.stat(path)
+        if self.hash_files:
+            return [st.st_size, file_hash(path, st.st_size)]
+        return [abspath(path), st.st_size, int(st.st_mtime*1e9)]
+
+    def key(self, tracks, radius):
+        """Key of the album made of tracks, checked for radius offsets"""
+        layout = tuple((t.path, t.start, t.num_samples) for t in tracks)
+        k = (layout, radius)
+        if k not in self._keys:
+            ids = [self.file_id(p) + [start, n] for p, start, n in layout]
+            self._keys[k] = hashlib.sha1(
+                json.dumps([radius, ids]).encode()).hexdigest()
+        return self._keys[k]
+
+    def get(self, key):
+        """Return the stored (arcfs, arcf450s, crc2s) for key, or None"""
+        try:
+            rows = self.db.execute('SELECT arcfs, arcf450s, crc2 FROM tracks '
+                                   'WHERE key = ? ORDER BY number',
+                                   (key,)).fetchall()
+        except (sqlite3.Error, OSError):
+            rows = []
+        if not rows:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return ([unpack(r[0]) for r in rows], [unpack(r[1]) for r in rows],
+                [r[2] for r in rows])
+
+    def put(self, key, tracks, radius, tables):
+        arcfs, arcf450s, crc2s = tables
+        try:
+            with self.db:
+                self.db.execute('DELETE FROM tracks WHERE key = ?', (key,))
+                self.db.execute('INSERT OR REPLACE INTO albums '
+                                '(key, radius, updated) VALUES (?, ?, ?)',
+                                (key, radius, time.time()))
+                self.db.executemany(
+                    'INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(key, i, t.path, arcfs[i][radius], crc2s[i],
+                      arcf450s[i][radius], pack(arcfs[i]), pack(arcf450s[i]))
+                     for i, t in enumerate(tracks)])
+        except (sqlite3.Error, OSError):
+            # like the dBAR cache, the store is just an optimization
+            pass
+
+    def set_status(self, key, status):
+        """Record the disc-level result of the last verification of key"""
+        try:
+            with self.db:
+                self.db.execute('UPDATE albums SET status = ?, updated = ? '
+                                'WHERE key = ?', (status, time.time(), key))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def summary(self):
+        return 'Checksum store: %i album%s from the store, %i recomputed' % \
+            (self.hits, 's' if self.hits != 1 else '', self.misses)
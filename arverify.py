@@ -5,16 +5,20 @@ import os
 import re
 import sys
 import struct
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from argparse import ArgumentParser
-from io import BytesIO
-from tempfile import TemporaryFile
+from array import array
 from os.path import basename, dirname, join
 from subprocess import Popen, PIPE
-try:
-    from urllib import urlopen
-except ImportError:
-    from urllib.request import urlopen
 
+import arcf
+import cuesheet
+import arcache
+import arclient
+import armirror
+import arprofile
+import arstore
 import utils
 from utils import SubprocessError, NotFromCDError,\
     AccurateripError, NetworkError
@@ -22,15 +26,28 @@ from utils import SubprocessError, NotFromCDError,\
 BIN = {'metaflac': None,
        'ffprobe' : 'avprobe',
        'sox'     : None,
+       'ffmpeg'  : 'avconv',
        'ckcdda'  : None,
        }
 
 PROGNAME = 'arverify'
 VERSION = '0.2'
-REQUIRED = ['ffprope', 'sox', 'ckcdda']
+REQUIRED = ['ffprope', 'ckcdda']
 PROCS = []
+CACHE = None
+MIRROR = None
+STORE = None
+CLIENT = arclient.Client()
 
 MIN_OFFSET = -2939
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+SEARCH_JOBS = 8
+# tracks decoded ahead in parallel, set by main (--decode-jobs)
+DECODE_JOBS = 1
+# dBAR chunk: track count, id1, id2, cddb, then one entry per track:
+# confidence, CRC, CRC450
+AR_CHUNK_HEADER = struct.Struct('<BIII')
+AR_ENTRY = struct.Struct('<BII')
 
 class AccurateripEntry(object):
     """Represents one entry in Accuraterip database. One track
@@ -38,6 +55,7 @@ class AccurateripEntry(object):
 
     TODO: See if there's a way to determine if crc is v1 or v2 beforehand
     """
+    __slots__ = ('crc', 'crc450', 'confidence')
     _fmt = '%-20s: CRC: %08X, Confidence: %3i, CRC450: %08X'
 
     def __init__(self, crc, crc450, confidence):
@@ -50,7 +68,15 @@ class AccurateripEntry(object):
                             self.crc450)
 
 class Track(object):
-    """One track and its associated metadata/information"""
+    """One track and its associated metadata/information
+
+    The database entries are kept in three parallel arrays, crcs, crc450s
+    and confidences; ar_entries gives them as AccurateripEntry objects.
+    """
+    __slots__ = ('path', 'start', 'name', 'num_samples', 'num_sectors',
+                 'crcs', 'crc450s', 'confidences', '_index',
+                 'exact_matches', 'possible_matches',
+                 'crc1', 'crc2', 'crc450')
     exact_match_msg = 'Accurately ripped'
     possible_match_msg = 'Possibly accurately ripped'
     not_accurate_msg = 'NOT accurately ripped'
@@ -61,13 +87,17 @@ class Track(object):
     _fmt = '%-20s: %08X'
     total_fmt = 'total %i submission%s'
 
-    def __init__(self, path):
+    def __init__(self, path, num_samples=None, start=0, name=None):
         self.path = path
-        self.num_samples = utils.get_num_samples(BIN, path)
+        self.start = start
+        self.name = name or path
+        if num_samples is None:
+            num_samples = utils.get_num_samples(BIN, path)
+        self.num_samples = num_samples
         self.num_sectors = int(self.num_samples/588)
         if self.num_samples % 588 != 0:
             msg = "%s not from CD (%i samples)\n" % \
-                (path, self.num_samples)
+                (self.name, self.num_samples)
             raise NotFromCDError(msg)
         self.ar_entries = []
 
@@ -75,9 +105,46 @@ class Track(object):
         self.exact_matches = {}
         self.possible_matches = {}
 
+    @property
+    def ar_entries(self):
+        return [AccurateripEntry(crc, crc450, confidence)
+                for crc, crc450, confidence in
+                zip(self.crcs, self.crc450s, self.confidences)]
+
+    @ar_entries.setter
+    def ar_entries(self, entries):
+        self.crcs = array(UINT32, [e.crc for e in entries])
+        self.crc450s = array(UINT32, [e.crc450 for e in entries])
+        self.confidences = array('B', [e.confidence for e in entries])
+        self._index = None
+
+    def add_entries(self, crcs, crc450s, confidences):
+        self.crcs.extend(crcs)
+        self.crc450s.extend(crc450s)
+        self.confidences.extend(confidences)
+        self._index = None
+
+    def entry_index(self):
+        """Return ({crc: entry numbers}, {crc450: entry numbers}) of the
+        database entries"""
+        if self._index is None:
+            by_crc, by_crc450 = {}, {}
+            for i, (crc, crc450) in enumerate(zip(self.crcs, self.crc450s)):
+                by_crc.setdefault(crc, []).append(i)
+                by_crc450.setdefault(crc450, []).append(i)
+            self._index = by_crc, by_crc450
+        return self._index
+
     @property
     def num_submissions(self):
-        return sum([e.confidence for e in self.ar_entries])
+        return sum(self.confidences)
+
+    @property
+    def not_accurate(self):
+        """Whether the track is in the database but matches none of its
+        entries at any offset"""
+        return bool(self.num_submissions and not self.exact_matches and
+                    not self.possible_matches)
 
     def __matches_summary(self, matches, msg, album_matches):
         summary = []
@@ -133,7 +200,8 @@ def process_arguments():
                        prog=PROGNAME)
     parser.add_argument('paths', metavar='file', nargs='+',
                         type=utils.isfile,
-                        help='lossless audio file')
+                        help='lossless audio file, or one CUE sheet of an '
+                        'image')
     parser.add_argument("-a", "--additional-sectors",
                         dest="additional_sectors", type=int,
                         help="additional pregap sectors beyond standard 150",
@@ -143,79 +211,312 @@ def process_arguments():
                         help="length of data track in sectors or mm:ss.ff",
                         default=0,
                         )
+    parser.add_argument("-e", "--engine",
+                        choices=['ckcdda', 'numpy'],
+                        default='ckcdda',
+                        help="calculate checksums with the ckcdda program "
+                        "or in-process with numpy",
+                        )
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=1,
+                        help="number of tracks to checksum in parallel "
+                        "(numpy engine only)",
+                        )
+    parser.add_argument("-r", "--radius", type=int,
+                        default=arcf.CHECK_RADIUS,
+                        help="check offsets from -RADIUS to +RADIUS samples "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--search-pregap", dest="search_pregap",
+                        type=utils.int_ranges, metavar='RANGES',
+                        help="try these additional pregap sectors (like "
+                        "0-75,150) until the disc is found in the database",
+                        )
+    parser.add_argument("--search-data", dest="search_data",
+                        type=utils.int_ranges, metavar='RANGES',
+                        help="try these data track lengths in sectors until "
+                        "the disc is found in the database",
+                        )
+    parser.add_argument("--search-jobs", dest="search_jobs", type=int,
+                        default=SEARCH_JOBS,
+                        help="number of disc IDs to look up at a time "
+                        "(default: %(default)s)",
+                        )
+    parser.add_argument("--probe-offset", dest="probe_offset",
+                        action='store_true', default=False,
+                        help="only decode frame 450 of every track and list "
+                        "the offsets its CRC450 matches at",
+                        )
+    parser.add_argument("--fail-fast", dest="fail_fast",
+                        action='store_true', default=False,
+                        help="stop decoding at the first track that is "
+                        "definitely not accurately ripped",
+                        )
+    arcache.add_cache_arguments(parser)
+    arclient.add_client_arguments(parser)
+    armirror.add_mirror_arguments(parser)
+    arstore.add_store_arguments(parser)
+    arprofile.add_profile_arguments(parser)
+    utils.add_decode_arguments(parser)
     utils.add_common_arguments(parser, VERSION)
 
-    return parser.parse_args()
+    options = parser.parse_args()
+    if options.offline and not options.cache:
+        parser.error('--offline requires the cache')
+    arclient.check_client_options(parser, options)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if options.decode_jobs < 1:
+        parser.error('--decode-jobs must be at least 1')
+    if options.search_jobs < 1:
+        parser.error('--search-jobs must be at least 1')
+    if not 0 <= options.radius <= arcf.MAX_RADIUS:
+        parser.error('--radius must be between 0 and %i' % arcf.MAX_RADIUS)
+    if options.jobs > 1 and options.engine != 'numpy':
+        parser.error('--jobs requires the numpy engine')
+
+    return options
+
+def match_offset(track, offset, crc1, crc450, crc2=None):
+    if offset == 0:
+        track.crc1 = crc1
+        track.crc2 = crc2
+        track.crc450 = crc450
+
+    by_crc, by_crc450 = track.entry_index()
+    exact = by_crc.get(crc1, [])
+    if crc2 is not None and crc2 != crc1 and crc2 in by_crc:
+        exact = sorted(exact + by_crc[crc2])
+    if exact:
+        track.exact_matches.setdefault(offset, []).extend(
+            track.confidences[i] for i in exact)
+    if offset != 0 and crc450 in by_crc450:
+        possible = [track.confidences[i] for i in by_crc450[crc450]
+                    if i not in exact]
+        if possible:
+            track.possible_matches.setdefault(offset, []).extend(possible)
+
+def match_track(track, crcs, crc450s, crc2, radius=arcf.CHECK_RADIUS):
+    """Match the checksums of one track with its database entries
+
+    Index radius of crcs and crc450s is offset 0.
+    """
+    match_offset(track, 0, crcs[radius], crc450s[radius], crc2)
+    by_crc, by_crc450 = track.entry_index()
+    if not by_crc:
+        return
+    for o, (crc, crc450) in enumerate(zip(crcs, crc450s)):
+        if o != radius and (crc in by_crc or crc450 in by_crc450):
+            match_offset(track, o-radius, crc, crc450)
+
+def match_tracks(tracks, arcfs, arcf450s, crc2s, radius=arcf.CHECK_RADIUS):
+    """Match the checksums returned by scan_files with the database entries
 
-def scan_files(tracks):
-    sox_args = ['sox']+[t.path for t in tracks]+['-t', 'raw', '-']
-    entries_per_track = max([len(t.ar_entries) for t in tracks])
-    ckcdda_args = [BIN['ckcdda'], entries_per_track]
+    Column radius of arcfs and arcf450s is offset 0.
+    """
+    for track, crcs, crc450s, crc2 in zip(tracks, arcfs, arcf450s, crc2s):
+        match_track(track, crcs, crc450s, crc2, radius)
 
-    for track in tracks:
-        ckcdda_args.append(str(track.num_sectors))
-        crcs = [e.crc for e in track.ar_entries]
-        crc450s = [e.crc450 for e in track.ar_entries]
-        crcs += [0]*(entries_per_track-len(crcs))
-        crc450s += [0]*(entries_per_track-len(crc450s))
-        ckcdda_args += crcs
-        ckcdda_args += crc450s
-
-    ckcdda_args = map(str, ckcdda_args)
-
-    tmp = TemporaryFile()
-    PROCS.append(Popen(sox_args, stdout=PIPE))
-    PROCS.append(Popen(ckcdda_args, stdin=PROCS[-1].stdout, stdout=tmp))
-
-    p = PROCS[-1]
-    while p.poll() is None:
-        utils.show_status('Calculating checksums for %i files', len(tracks))
-    utils.finish_status()
+def get_tracks(paths):
+    """Return the Tracks of a disc and its additional pregap sectors
 
-    out, err = p.communicate()
-    tmp.seek(0)
-    out = tmp.read().decode()
-    for pr in PROCS:
-        if pr.returncode:
-            raise SubprocessError('sox had an error (returned %i)' %
-                                  pr.returncode)
-
-    lines = out.split('\n')
-    num_lines = len(lines)
-
-    results1 = []
-    results2 = []
-    results450 = []
-    for i, line in enumerate(lines):
-        if not re.match('^\d', line):
-            continue
-
-        index, data = line.split(': ')
-        track_index, offset = [int(x) for x in index.split(',')]
-        hashes = [int(x, 16) for x in data.split()]
-
-        crc1, crc450 = hashes[:2]
-        if len(hashes) > 2:
-            crc2 = hashes[2]
-        else:
-            crc2 = None
+    paths is either one file per track or a single CUE sheet.
+    """
+    if cuesheet.is_cue(paths):
+        layout, additional_sectors = cuesheet.read_tracks(BIN, paths[0])
+        tracks = [Track(path, n, start, cuesheet.track_name(paths[0], number))
+                  for path, start, n, number in layout]
+        return tracks, additional_sectors
 
-        track = tracks[track_index]
+    counts = utils.probe_num_samples(BIN, paths)
+    return [Track(path, n) for path, n in zip(paths, counts)], 0
 
-        if offset == 0:
-            track.crc1 = crc1
-            track.crc2 = crc2
-            track.crc450 = crc450
+def scan_files(tracks, engine='ckcdda', jobs=1, radius=arcf.CHECK_RADIUS):
+    """Return (arcfs, arcf450s, crc2s) for tracks
 
-        for entry in track.ar_entries:
-            if entry.crc in (crc1, crc2):
-                if offset not in track.exact_matches:
-                    track.exact_matches[offset] = []
-                track.exact_matches[offset].append(entry.confidence)
-            elif entry.crc450 == crc450 and offset != 0:
-                if offset not in track.possible_matches:
-                    track.possible_matches[offset] = []
-                track.possible_matches[offset].append(entry.confidence)
+    arcfs and arcf450s hold one list per track with the checksums for
+    offsets -radius to radius.
+    """
+    rows = [row[1:] for row in iter_scan(tracks, engine, jobs, radius)]
+    return tuple(list(column) for column in zip(*rows))
+
+def iter_scan(tracks, engine='ckcdda', jobs=1, radius=arcf.CHECK_RADIUS):
+    """Yield (index, arcfs, arcf450s, crc2) for every track in order, each
+    as soon as it's known
+
+    A track is known once the decoder has moved radius samples past its
+    end. Decoding stops when the iterator is closed early.
+    """
+    if engine == 'numpy':
+        return iter_scan_numpy(tracks, jobs, radius)
+    else:
+        return iter_scan_ckcdda(tracks, radius)
+
+def decode_tracks(tracks, jobs=None):
+    """Yield the samples of tracks as one stream
+
+    With one job, consecutive tracks of an image are decoded in one go.
+    With more, every track is decoded from its own position and up to jobs
+    of them ahead at a time (see utils.ordered_blocks). jobs defaults to
+    DECODE_JOBS.
+    """
+    jobs = DECODE_JOBS if jobs is None else jobs
+    runs = []
+    for t in tracks:
+        if jobs <= 1 and runs and runs[-1][0] == t.path and \
+                sum(runs[-1][1:]) == t.start:
+            runs[-1][2] += t.num_samples
+        else:
+            runs.append([t.path, t.start, t.num_samples])
+    sources = [lambda path=path, start=start, count=count:
+               utils.open_audio(BIN, path, PROCS).blocks(start, count)
+               for path, start, count in runs]
+    return utils.ordered_blocks(sources, jobs)
+
+def iter_scan_ckcdda(tracks, radius=arcf.CHECK_RADIUS):
+    """iter_scan with ckcdda, which writes the record of every track as
+    soon as it's final
+
+    The samples are written from a background thread, so ckcdda never
+    blocks on a full pipe while we're reading its output.
+    """
+    ckcdda_args = [BIN['ckcdda'], '-r', str(radius), '-b']
+    ckcdda_args += [str(t.num_sectors) for t in tracks]
+
+    p = Popen(ckcdda_args, stdin=PIPE, stdout=PIPE)
+    PROCS.append(p)
+    progress = utils.Progress('checksum', 'Calculating checksums for %i '
+                              'files' % len(tracks),
+                              sum(t.num_samples for t in tracks))
+    writer = utils.BackgroundCall(utils.write_blocks, p, decode_tracks(tracks),
+                                  progress)
+    n = 2*radius+1
+    size = (2*n+1)*4
+    count = 0
+    try:
+        for i in range(len(tracks)):
+            record = p.stdout.read(size)
+            if utils.PROFILE:
+                utils.PROFILE.piped(p, len(record), stdout=True)
+            if len(record) != size:
+                break
+            with utils.profile_stage('parse', size):
+                row = array(UINT32)
+                row.frombytes(record)
+                crcs, crc450s = row[:n].tolist(), row[n:2*n].tolist()
+            yield i, crcs, crc450s, row[2*n]
+            count += 1
+        returncode = writer.result()
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        progress.finish()
+
+    if returncode:
+        raise SubprocessError('ckcdda had an error (returned %i)' %
+                              returncode)
+    if count != len(tracks):
+        raise SubprocessError('ckcdda returned %i tracks, expected %i' %
+                              (count, len(tracks)))
+
+def scan_track(args):
+    """Process pool job: checksum state of the tracks touched by one file
+
+    The file is fed at its position in the album, so its samples end up in
+    the windows of neighbouring tracks as well as its own.
+    """
+    binaries, lengths, radius, index, path, start = args
+    engine = arcf.ARCFEngine(lengths, sum(lengths[:index]), radius)
+    audio = utils.open_audio(binaries, path)
+    for block in audio.blocks(start, lengths[index]):
+        engine.update(block)
+    return index, engine.states()
+
+def iter_scan_numpy(tracks, jobs=1, radius=arcf.CHECK_RADIUS):
+    """iter_scan in-process; with more than one job the tracks are only
+    known once all jobs are done"""
+    lengths = [t.num_samples for t in tracks]
+    engine = arcf.ARCFEngine(lengths, radius=radius)
+    progress = utils.Progress('checksum', 'Calculating checksums for %i '
+                              'files' % len(tracks), sum(lengths))
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, utils.init_worker)
+        try:
+            args = [(BIN, lengths, radius, i, t.path, t.start)
+                    for i, t in enumerate(tracks)]
+            with utils.profile_stage('checksum'):
+                for index, states in pool.imap_unordered(scan_track, args):
+                    engine.merge(states)
+                    progress.update(lengths[index])
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+    else:
+        for block in utils.profile_blocks(decode_tracks(tracks), 'decode'):
+            with utils.profile_stage('checksum', len(block)):
+                engine.update(block)
+            progress.update(len(block)//utils.BYTES_PER_SAMPLE)
+            for i, arcfs, arcf450s, crc2 in engine.finished():
+                yield i, arcfs.tolist(), arcf450s.tolist(), crc2
+    progress.finish()
+
+    for i, arcfs, arcf450s, crc2 in engine.finished(final=True):
+        yield i, arcfs.tolist(), arcf450s.tolist(), crc2
+
+def scan_frame450(tracks, radius=arcf.CHECK_RADIUS):
+    """Return arcf450s like scan_files, decoding only the samples around
+    frame 450 of every track"""
+    n = arcf.SAMPLES_PER_FRAME + 2*radius
+    frame_start = arcf.FRAME450 - radius
+    arcf450s = []
+    for i, track in enumerate(tracks):
+        utils.update_status('Calculating CRC450s for %i files (%i/%i)',
+                            len(tracks), i+1, len(tracks))
+        hi = track.num_samples
+        if i == len(tracks)-1:
+            hi -= arcf.SKIP_LAST
+        a, b = frame_start, min(frame_start+n, hi)
+        frame = array(UINT32, [0])*n
+        if a < b:
+            samples = array(UINT32)
+            audio = utils.open_audio(BIN, track.path, PROCS)
+            for block in audio.blocks(track.start+a, b-a):
+                samples.frombytes(bytes(block))
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            frame[:b-a] = samples
+        arcf450s.append(arcf.frame450_crcs(frame, hi, radius))
+    utils.finish_status()
+    return arcf450s
+
+def probe_offsets(tracks, arcf450s, radius=arcf.CHECK_RADIUS):
+    """Return {offset: [confidence of each track whose CRC450 matches]}"""
+    offsets = {}
+    for track, crc450s in zip(tracks, arcf450s):
+        dbcrc450s = {}
+        for crc450, confidence in zip(track.crc450s, track.confidences):
+            if crc450:
+                dbcrc450s[crc450] = dbcrc450s.get(crc450, 0) + confidence
+        for i, crc450 in enumerate(crc450s):
+            if crc450 in dbcrc450s:
+                offsets.setdefault(i-radius, []).append(dbcrc450s[crc450])
+    return offsets
+
+def print_probe(tracks, offsets):
+    total = len(tracks)
+    mfmt = '%i/%i' if total < 10 else '%2i/%2i'
+    for offset in sorted(offsets, key=lambda o: (-len(offsets[o]),
+                                                 -sum(offsets[o]), abs(o))):
+        print((mfmt+' tracks match with offset %i (confidence %i)') %
+              (len(offsets[offset]), total, offset, sum(offsets[offset])))
+    if not offsets:
+        print('No offset found')
+        return 1
+    return 0
 
 def get_disc_ids(tracks, additional_sectors=0, data_track_len=0,
                  verbose=False):
@@ -266,79 +567,148 @@ def get_disc_ids(tracks, additional_sectors=0, data_track_len=0,
 
     return (cddb, id1, id2)
 
-def get_ar_entries(cddb, id1, id2, tracks, verbose=False):
-    url = ("http://www.accuraterip.com/accuraterip/"+
-           "%.1x/%.1x/%.1x/dBAR-%.3d-%.8x-%.8x-%.8x.bin")
-    url = url % (id1 & 0xF, id1>>4 & 0xF, id1>>8 & 0xF,
-                 len(tracks), id1, id2, cddb)
-    if verbose:
-        print(url)
+def get_ar_entries(cddb, id1, id2, tracks, verbose=False, data=None):
+    """Add the database entries of the disc to tracks
 
+    data is the dBAR response if it has been fetched already.
+    """
+    if data is None:
+        with utils.profile_stage('fetch'):
+            data = fetch_ar_data((len(tracks), id1, id2, cddb), verbose)
+    return process_binary_ar_entries(bytes(data), cddb, id1, id2, tracks)
+
+def fetch_ar_data(key, verbose=False):
+    """Return the dBAR response for key from the mirror, the cache or the
+    server"""
+    data = MIRROR.get(key) if MIRROR else None
+    if data is not None:
+        if verbose:
+            print('Using mirrored %s' % arcache.filename(key))
+        return data
+    data = CACHE.get(key) if CACHE else None
+    if data is None:
+        if CACHE and CACHE.offline:
+            raise NetworkError("%s not in cache (offline mode)" %
+                               arcache.filename(key))
+        data = download_ar_entries(key, verbose)
+        if CACHE:
+            CACHE.put(key, data)
+    elif verbose:
+        print('Using cached %s' % arcache.filename(key))
+
+    return data
+
+def search_job(key):
+    """Thread pool job: the dBAR response for key, or None if it's empty"""
     try:
-        data = urlopen(url).read()
-    except IOError:
-        raise NetworkError("Could not connect to accuraterip database")
-    if b'html' in data and b'404' in data:
-        data = b''
+        return fetch_ar_data(key) or None
+    except NetworkError:
+        if CACHE and CACHE.offline:
+            return None
+        raise
+
+def search_disc_ids(tracks, candidates, jobs=SEARCH_JOBS):
+    """Return (candidate, disc ids, dBAR response) of the first candidate
+    the database knows, or None
+
+    candidates are (additional sectors, data track length) pairs; jobs of
+    them are looked up at a time.
+    """
+    ids = [get_disc_ids(tracks, a, d) for a, d in candidates]
+    keys = [(len(tracks), id1, id2, cddb) for cddb, id1, id2 in ids]
+    found = None
+    pool = ThreadPool(min(jobs, len(keys)))
+    try:
+        for i, data in enumerate(pool.imap(search_job, keys)):
+            utils.update_status('Searching disc IDs (%i/%i)', i+1, len(keys))
+            if data:
+                found = candidates[i], ids[i], data
+                break
+    finally:
+        pool.terminate()
+    utils.finish_status()
+    return found
+
+def download_ar_entries(key, verbose=False):
+    """Return the dBAR file for key, or an empty string if there's none"""
+    if verbose:
+        print(CLIENT.url(key))
+    return CLIENT.fetch(key)
+
+def iter_unpack(fmt, data):
+    """struct.iter_unpack, which python 2 lacks"""
+    if hasattr(fmt, 'iter_unpack'):
+        return fmt.iter_unpack(data)
+    return (fmt.unpack_from(data, i) for i in range(0, len(data), fmt.size))
 
-    return process_binary_ar_entries(BytesIO(bytes(data)), cddb, id1, id2,
-                                     tracks)
+def process_binary_ar_entries(data, cddb, id1, id2, tracks):
+    """Add the entries of a dBAR response (or a file holding one) to tracks
 
-def process_binary_ar_entries(fdata, cddb, id1, id2, tracks):
-    if not fdata:
+    The response is a run of chunks, one per pressing: a header with the
+    track count and disc ids, then confidence, CRC and CRC450 of every
+    track. A truncated last chunk adds the entries it has.
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    if not data or not tracks:
         return
 
     trackcount = len(tracks)
-
-    while True:
-        chunk_trackcount = fdata.read(1)
-        chunk_id1 = fdata.read(4)
-        chunk_id2 = fdata.read(4)
-        chunk_cddb = fdata.read(4)
-        if len(chunk_trackcount) + len(chunk_id1) + len(chunk_id2) + \
-                len(chunk_cddb) != 13:
-            break
-        # unpack as unsigned char
-        ar_trackcount = int(struct.unpack('B', chunk_trackcount)[0])
-
-        # unpack as unsigned integers
-        ar_id1 = int(struct.unpack('I', chunk_id1)[0])
-        ar_id2 = int(struct.unpack('I', chunk_id2)[0])
-        ar_cddb = int(struct.unpack('I', chunk_cddb)[0])
-        if ar_trackcount != trackcount or \
-                ar_id1 != id1 or ar_id2 != id2 or ar_cddb != cddb:
+    size = AR_CHUNK_HEADER.size + trackcount*AR_ENTRY.size
+    key = (trackcount, id1, id2, cddb)
+    bodies = []
+    for offset in range(0, len(data) - AR_CHUNK_HEADER.size + 1, size):
+        if AR_CHUNK_HEADER.unpack_from(data, offset) != key:
             raise AccurateripError("Track count or Disc IDs don't match")
-        for track in tracks:
-            chunk_confidence = fdata.read(1)
-            chunk_crc = fdata.read(4)
-            chunk_crc450 = fdata.read(4) # skip 4 bytes
-            if len(chunk_crc) + len(chunk_confidence) + len(chunk_crc450) != 9:
-                break
-            confidence = int(struct.unpack('B', chunk_confidence)[0])
-            crc = int(struct.unpack('I', chunk_crc)[0])
-            crc450 = int(struct.unpack('I', chunk_crc450)[0])
-            track.ar_entries.append(AccurateripEntry(crc, crc450, confidence))
-
-def print_summary(tracks, verbose=False):
-    summary = []
-
+        end = min(offset + size, len(data))
+        entries = (end - offset - AR_CHUNK_HEADER.size) // AR_ENTRY.size
+        start = offset + AR_CHUNK_HEADER.size
+        bodies.append(data[start:start + entries*AR_ENTRY.size])
+
+    # entry i of the response belongs to track i % trackcount
+    entries = list(iter_unpack(AR_ENTRY, b''.join(bodies)))
+    for i, track in enumerate(tracks):
+        rows = entries[i::trackcount]
+        if rows:
+            confidences, crcs, crc450s = zip(*rows)
+            track.add_entries(crcs, crc450s, confidences)
+
+def track_summary(track, verbose=False, good=None, maybe=None, np=None,
+                  bad=None):
+    """Return the report of one track, adding it to the album tallies"""
+    lines = [track.name]
+    lines += track.calcsummary(verbose)
+    if verbose:
+        lines += track.dbsummary()
+    lines.append('-'*len(lines[-1]))
+    lines += track.ripsummary({} if good is None else good,
+                              {} if maybe is None else maybe,
+                              [] if np is None else np,
+                              [] if bad is None else bad)
+    return '\n    '.join(lines)
+
+def print_summary(tracks, verbose=False, streamed=False, total=None):
+    """Print the report of every track and the album totals; returns the
+    number of inaccurate tracks
+
+    With streamed the track reports have been printed already. total is
+    the number of tracks of the album if only the first ones were checked.
+    """
     good = {}      # Matching main CRC (with or without offset)
     maybe = {}     # main CRC mismatch and CRC450 match
     bad = []       # main CRC mismatch and no CRC450 match
     np = []        # No accuraterip data at all
 
-    for track in tracks:
-        lines = [track.path]
-        lines += track.calcsummary(verbose)
-        if verbose:
-            lines += track.dbsummary()
-        lines.append('-'*len(lines[-1]))
-        lines += track.ripsummary(good, maybe, np, bad)
-        summary.append('\n    '.join(lines))
-
-    print('\n\n'.join(summary))
-    print('\n'+'='*80)
+    summary = [track_summary(track, verbose, good, maybe, np, bad)
+               for track in tracks]
+    if streamed:
+        print('='*80)
+    else:
+        print('\n\n'.join(summary))
+        print('\n'+'='*80)
 
+    if total is not None and total != len(tracks):
+        print('Stopped after %i of %i tracks' % (len(tracks), total))
     total = len(tracks)
     mfmt = '%i/%i' if total < 10 else '%2i/%2i'
     for offset in sorted(good.keys(), key=abs):
@@ -364,16 +734,122 @@ def print_summary(tracks, verbose=False):
 
     return len(bad)
 
+def disc_status(tracks):
+    if all(t.num_submissions == 0 for t in tracks):
+        return 'not present'
+    if all(t.exact_matches for t in tracks if t.num_submissions):
+        return 'accurate'
+    if all(t.exact_matches or t.possible_matches
+           for t in tracks if t.num_submissions):
+        return 'possibly accurate'
+    return 'not accurate'
+
+def iter_verify(tracks, cddb, id1, id2, engine='ckcdda', jobs=1,
+                radius=arcf.CHECK_RADIUS, verbose=False, data=None):
+    """Calculate checksums and match them with the database entries,
+    yielding every track as soon as it's matched
+
+    The database is queried in the background while the files are decoded,
+    unless its response is passed as data. Checksums of albums that are in
+    STORE aren't recalculated; they're stored once all tracks are done,
+    along with the disc_status. Closing the iterator early stops decoding.
+    """
+    fetch = utils.BackgroundCall(get_ar_entries, cddb, id1, id2, tracks,
+                                 verbose, data)
+    tables = None
+    if STORE:
+        with utils.profile_stage('store'):
+            key = STORE.key(tracks, radius)
+            tables = STORE.get(key)
+    if tables is None:
+        rows = iter_scan(tracks, engine, jobs, radius)
+    else:
+        rows = ((i,) + row for i, row in enumerate(zip(*tables)))
+
+    results = []
+    for i, crcs, crc450s, crc2 in rows:
+        if not results:
+            fetch.result()
+        with utils.profile_stage('match'):
+            match_track(tracks[i], crcs, crc450s, crc2, radius)
+        results.append((crcs, crc450s, crc2))
+        yield tracks[i]
+
+    if STORE:
+        with utils.profile_stage('store'):
+            if tables is None:
+                STORE.put(key, tracks, radius, tuple(zip(*results)))
+            STORE.set_status(key, disc_status(tracks))
+
+def verify_tracks(tracks, cddb, id1, id2, engine='ckcdda', jobs=1,
+                  radius=arcf.CHECK_RADIUS, verbose=False, data=None):
+    """Calculate checksums and match them with the database entries"""
+    for track in iter_verify(tracks, cddb, id1, id2, engine, jobs, radius,
+                             verbose, data):
+        pass
+
 def main(options):
-    utils.check_dependencies(BIN, REQUIRED)
-    tracks = [Track(path) for path in options.paths]
+    global CACHE, MIRROR, STORE, CLIENT, DECODE_JOBS
+    CACHE = arcache.from_options(options)
+    MIRROR = armirror.from_options(options)
+    CLIENT = arclient.from_options(options)
+    STORE = arstore.from_options(options)
+    DECODE_JOBS = options.decode_jobs
+    required = REQUIRED
+    if options.engine == 'numpy':
+        arcf.check_numpy()
+        required = [r for r in REQUIRED if r != 'ckcdda']
+    utils.check_dependencies(BIN, required)
+    with utils.profile_stage('probe'):
+        tracks, additional_sectors = get_tracks(options.paths)
+
+    pregap = options.additional_sectors
+    data_track_len = options.data_track_len
+    data = None
+    if options.search_pregap or options.search_data:
+        candidates = [(additional_sectors + a, d)
+                      for a in options.search_pregap or [pregap]
+                      for d in options.search_data or [data_track_len]]
+        with utils.profile_stage('search'):
+            found = search_disc_ids(tracks, candidates, options.search_jobs)
+        if found:
+            (a, data_track_len), ids, data = found
+            pregap = a - additional_sectors
+            print('Found in database with %i additional pregap sectors and '
+                  'data track length %s' % (pregap, data_track_len))
+        else:
+            print('None of %i disc IDs found in database' % len(candidates))
 
-    cddb, id1, id2 = get_disc_ids(tracks, options.additional_sectors,
-                                  options.data_track_len, options.verbose)
+    cddb, id1, id2 = get_disc_ids(tracks, pregap + additional_sectors,
+                                  data_track_len, options.verbose)
     print('Disc ID: %08x-%08x-%08x' % (id1, id2, cddb))
-    get_ar_entries(cddb, id1, id2, tracks, options.verbose)
-    scan_files(tracks)
-    return print_summary(tracks, options.verbose)
+    if options.probe_offset:
+        fetch = utils.BackgroundCall(get_ar_entries, cddb, id1, id2, tracks,
+                                     options.verbose, data)
+        with utils.profile_stage('frame450'):
+            arcf450s = scan_frame450(tracks, options.radius)
+        fetch.result()
+        CLIENT.close()
+        return print_probe(tracks, probe_offsets(tracks, arcf450s,
+                                                 options.radius))
+    checked = []
+    for track in iter_verify(tracks, cddb, id1, id2, options.engine,
+                             options.jobs, options.radius, options.verbose,
+                             data):
+        checked.append(track)
+        print(track_summary(track, options.verbose) + '\n')
+        sys.stdout.flush()
+        if options.fail_fast and track.not_accurate:
+            break
+    CLIENT.close()
+    if MIRROR and options.verbose:
+        print(MIRROR.summary())
+    if CACHE and options.verbose:
+        print(CACHE.summary())
+    if STORE and options.verbose:
+        print(STORE.summary())
+    return print_summary(checked, options.verbose, True, len(tracks))
 
 if __name__ == '__main__':
-    utils.execute(main, process_arguments, PROCS)
+    utils.execute(arprofile.profiled(main, PROGNAME), process_arguments,
+                  PROCS)
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+"""Verify discs as they land in inbox directories
+
+Every directory below the watched ones is a disc, like in arbatch. A disc
+is verified once its files haven't changed for --settle seconds, by a pool
+of worker processes that stays up for the life of the daemon, so
+dependencies are resolved once and the dBAR cache, database connections
+and checksum store stay warm. Changes are noticed with inotify on Linux,
+and by rescanning every --interval seconds elsewhere.
+
+Results are appended to --output as JSON records like arbatch's and can be
+queried over a unix socket (--socket): send a line with a path to get the
+record of the disc containing it, "list" for all records or "status" for
+the counts, and read one JSON line back.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import threading
+import ctypes
+import ctypes.util
+import multiprocessing
+from argparse import ArgumentParser
+from os.path import abspath, dirname, exists
+try:
+    from SocketServer import ThreadingMixIn, StreamRequestHandler
+    from SocketServer import UnixStreamServer
+except ImportError:
+    from socketserver import ThreadingMixIn, StreamRequestHandler
+    try:
+        from socketserver import UnixStreamServer
+    except ImportError:
+        UnixStreamServer = None
+
+import arbatch
+import arcache
+import arclient
+import armirror
+import arstore
+import arverify
+import utils
+
+PROGNAME = 'arwatch'
+VERSION = '0.2'
+PROCS = []
+
+PARTIAL_SUFFIXES = ('.part', '.partial', '.tmp', '~')
+# inotify_add_watch mask: IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+# IN_CREATE, IN_DELETE
+IN_EVENTS = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+def process_arguments():
+    parser = \
+        ArgumentParser(description='Watch directories and verify the discs '
+                       'that land in them.', prog=PROGNAME)
+    parser.add_argument('dirs', metavar='dir', nargs='+',
+                        type=utils.isdir,
+                        help='directory to watch (one subdirectory per disc)')
+    parser.add_argument('-o', '--output',
+                        help='append results to this file (one JSON record '
+                        'per disc)')
+    parser.add_argument('--socket',
+                        help='answer queries for results on this unix '
+                        'socket')
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of discs to verify in parallel",
+                        )
+    parser.add_argument("-e", "--engine",
+                        choices=['ckcdda', 'numpy'],
+                        default='ckcdda',
+                        help="calculate checksums with the ckcdda program "
+                        "or in-process with numpy",
+                        )
+    parser.add_argument("--settle", type=float, default=30,
+                        help="seconds a disc's files must stay unchanged "
+                        "before it is verified (default: %(default)s)",
+                        )
+    parser.add_argument("--interval", type=float, default=10,
+                        help="seconds between rescans (default: "
+                        "%(default)s)",
+                        )
+    parser.add_argument("--no-inotify", dest="inotify",
+                        action='store_false', default=True,
+                        help="only rescan every --interval seconds",
+                        )
+    parser.add_argument("--once", action='store_true', default=False,
+                        help="verify the discs that are there now and exit",
+                        )
+    arcache.add_cache_arguments(parser)
+    arclient.add_client_arguments(parser)
+    armirror.add_mirror_arguments(parser)
+    arstore.add_store_arguments(parser)
+    utils.add_common_arguments(parser, VERSION)
+
+    options = parser.parse_args()
+    if options.offline and not options.cache:
+        parser.error('--offline requires the cache')
+    arclient.check_client_options(parser, options)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if options.settle < 0 or options.interval <= 0:
+        parser.error('--settle and --interval must be positive')
+    if options.socket and UnixStreamServer is None:
+        parser.error('--socket needs unix sockets')
+
+    return options
+
+def directory_signature(path):
+    """Names, sizes and mtimes of the files in path, or None if it can't
+    be read or is still being written (has partial files)"""
+    try:
+        signature = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(PARTIAL_SUFFIXES):
+                return None
+            st = os.stat(os.path.join(path, name))
+            signature.append((name, st.st_size, st.st_mtime))
+    except OSError:
+        return None
+    return tuple(signature)
+
+class Notifier(object):
+    """Waits for changes below directories with inotify, or for a timeout
+    where inotify isn't available"""
+    def __init__(self, use_inotify=True):
+        self.fd = None
+        self.watched = set()
+        if not use_inotify or not sys.platform.startswith('linux'):
+            return
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True)
+            fd = self.libc.inotify_init()
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.fd = fd
+
+    def watch(self, tops):
+        """Watch every directory below tops that isn't watched yet"""
+        if self.fd is None:
+            return
+        current = set()
+        for top in tops:
+            for dirpath, dirnames, filenames in os.walk(top):
+                current.add(dirpath)
+                if dirpath not in self.watched:
+                    path = dirpath.encode(sys.getfilesystemencoding()) \
+                        if not isinstance(dirpath, bytes) else dirpath
+                    self.libc.inotify_add_watch(self.fd, path, IN_EVENTS)
+        # the kernel drops the watches of removed directories
+        self.watched = current
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # the events only wake us up, the discs are rescanned
+            os.read(self.fd, 64*1024)
+            # let a burst of events (a disc being copied) pass
+            time.sleep(min(timeout, 0.5))
+
+class Watcher(object):
+    """Finds the discs below tops whose files have settled"""
+    def __init__(self, tops, settle):
+        self.tops = tops
+        self.settle = settle
+        self.seen = {}    # disc directory: (signature, time of last change)
+        self.queued = {}  # disc directory: signature last queued
+
+    def scan(self, now, settle=None):
+        """Return the discs that are ready to be verified"""
+        settle = self.settle if settle is None else settle
+        ready = []
+        current = set()
+        for top in self.tops:
+            for paths in arbatch.find_discs(top):
+                disc = dirname(paths[0])
+                current.add(disc)
+                signature = directory_signature(disc)
+                if signature is None:
+                    self.seen.pop(disc, None)
+                    continue
+                old = self.seen.get(disc)
+                if old is None or old[0] != signature:
+                    self.seen[disc] = (signature, now)
+                    if settle:
+                        continue
+                if self.queued.get(disc) != signature and \
+                        now - self.seen[disc][1] >= settle:
+                    self.queued[disc] = signature
+                    ready.append(paths)
+        for disc in set(self.seen) - current:
+            del self.seen[disc]
+            self.queued.pop(disc, None)
+        return ready
+
+    def next_deadline(self):
+        """Time at which the next unsettled disc settles, or None"""
+        pending = [t for disc, (signature, t) in self.seen.items()
+                   if self.queued.get(disc) != signature]
+        return min(pending) + self.settle if pending else None
+
+class Results(object):
+    """Records of the verified discs, appended to output as they come in"""
+    def __init__(self, output=None):
+        self.records = {}
+        self.queued = set()
+        self.counts = {}
+        self.output = output
+        self.lock = threading.Lock()
+
+    def queue(self, paths):
+        with self.lock:
+            self.queued.add(dirname(paths[0]))
+
+    def add(self, record):
+        disc = dirname(record['paths'][0])
+        with self.lock:
+            self.queued.discard(disc)
+            self.records[disc] = record
+            self.counts[record['status']] = \
+                self.counts.get(record['status'], 0) + 1
+            if self.output:
+                with open(self.output, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True)+'\n')
+
+    def query(self, request):
+        with self.lock:
+            if request == 'list':
+                return sorted(self.records.values(),
+                              key=lambda r: r['paths'][0])
+            if request == 'status':
+                return dict(self.counts, queued=len(self.queued))
+            path = abspath(request)
+            for disc in (path, dirname(path)):
+                if disc in self.records:
+                    return self.records[disc]
+                if disc in self.queued:
+                    return dict(paths=[disc], status='queued')
+        return dict(paths=[request], status='unknown')
+
+class QueryServer(ThreadingMixIn, UnixStreamServer or object):
+    daemon_threads = True
+
+class QueryHandler(StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').strip()
+        response = self.server.results.query(request)
+        self.wfile.write((json.dumps(response, sort_keys=True) +
+                          '\n').encode('utf-8'))
+
+def serve_queries(path, results):
+    if exists(path):
+        os.unlink(path)
+    server = QueryServer(path, QueryHandler)
+    server.results = results
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main(options):
+    required = arverify.REQUIRED
+    if options.engine == 'numpy':
+        arverify.arcf.check_numpy()
+        required = [r for r in required if r != 'ckcdda']
+    utils.check_dependencies(arverify.BIN, required)
+
+    tops = [abspath(d) for d in options.dirs]
+    results = Results(options.output)
+    server = serve_queries(options.socket, results) if options.socket \
+        else None
+    watcher = Watcher(tops, options.settle)
+    notifier = Notifier(options.inotify)
+    pool = multiprocessing.Pool(options.jobs, arbatch.init_worker,
+                                (arverify.BIN, arcache.from_options(options),
+                                 arclient.from_options(options),
+                                 arstore.from_options(options),
+                                 armirror.from_options(options)))
+
+    def done(record):
+        results.add(record)
+        print('%s: %s' % (record['status'], dirname(record['paths'][0])),
+              file=sys.stderr)
+
+    def failed(paths):
+        # verify_disc returns an error record for any failure of its own,
+        # this catches the rest, e.g. an unpicklable result
+        return lambda e: done(dict(paths=paths, status='error',
+                                   error='%s: %s' % (type(e).__name__, e)))
+
+    if options.verbose:
+        print('Watching %s (%s)' % (', '.join(tops), 'inotify'
+                                    if notifier.fd is not None
+                                    else 'polling'), file=sys.stderr)
+    try:
+        while True:
+            notifier.watch(tops)
+            now = time.time()
+            discs = watcher.scan(now, 0 if options.once else None)
+            for paths in discs:
+                results.queue(paths)
+                kwargs = dict(callback=done)
+                if sys.version_info[0] > 2:
+                    kwargs['error_callback'] = failed(paths)
+                pool.apply_async(arbatch.verify_disc,
+                                 ((paths, options.engine),), **kwargs)
+            if options.once:
+                break
+            timeout = options.interval
+            deadline = watcher.next_deadline()
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - now), 0.1)
+            notifier.wait(timeout)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            os.unlink(options.socket)
+    pool.close()
+    pool.join()
+
+    counts = results.counts
+    print('%i discs: %s' % (sum(counts.values()), ', '.join(
+        '%i %s' % (counts[s], s) for s in sorted(counts))), file=sys.stderr)
+    return 1 if counts.get('not accurate') or counts.get('error') else 0
+
+if __name__ == '__main__':
+    utils.execute(main, process_arguments, PROCS)
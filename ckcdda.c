@@ -2,29 +2,192 @@
 
 /* ARCF: AccurateRip Checksum (Flawed) */
 
+#define _POSIX_C_SOURCE 200112L
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <stdint.h>
 #include <string.h>
 
+#if defined(__unix__) || defined(__APPLE__)
+#define HAVE_MMAP 1
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#endif
+
 #define SAMPLES_PER_FRAME  588 /* = 44100 / 75 */
 #define CHECK_RADIUS  (5*SAMPLES_PER_FRAME-1)
-#define ARCFS_PER_TRACK  (2*CHECK_RADIUS+1)
+#define MAX_RADIUS  (450*SAMPLES_PER_FRAME)
+
+/* Samples left out at the start of the first
+   and the end of the last track. */
+#define SKIP_FIRST  (5*SAMPLES_PER_FRAME-1)
+#define SKIP_LAST  (5*SAMPLES_PER_FRAME)
+
+#define ARCF_IDX(track,offset)  ((offset) + (track)*arcfs_per_track)
 
-#define ARCF_IDX(track,offset)  ((offset) + (track)*ARCFS_PER_TRACK)
+#define MIN(a,b) ((a) < (b) ? (a) : (b))
 
+/* Stereo samples per read from stdin */
+#define BLOCK_SAMPLES  (64*1024)
+
+/* Offsets from -radius to +radius are checked */
+static int radius = CHECK_RADIUS;
+static int arcfs_per_track = 2*CHECK_RADIUS+1;
+
+/* Open addressing hash set of (track, crc) pairs */
+struct crc_set {
+    uint32_t *crc;
+    int *track;   /* -1 for empty slots */
+    uint32_t mask;
+};
+
+static uint32_t
+crc_hash(uint32_t crc, int track)
+{
+    uint32_t h = crc ^ ((uint32_t) track * 0x9E3779B1u);
+    h ^= h >> 16;
+    h *= 0x85EBCA6Bu;
+    h ^= h >> 13;
+    return h;
+}
+
+static void
+crc_set_add(struct crc_set *set, uint32_t crc, int track)
+{
+    uint32_t i = crc_hash(crc, track) & set->mask;
+    while (set->track[i] != -1) {
+        if (set->crc[i] == crc && set->track[i] == track)
+            return;
+        i = (i+1) & set->mask;
+    }
+    set->crc[i] = crc;
+    set->track[i] = track;
+}
+
+static int
+crc_set_contains(const struct crc_set *set, uint32_t crc, int track)
+{
+    uint32_t i = crc_hash(crc, track) & set->mask;
+    while (set->track[i] != -1) {
+        if (set->crc[i] == crc && set->track[i] == track)
+            return 1;
+        i = (i+1) & set->mask;
+    }
+    return 0;
+}
+
+/* Sample input, either memory mapped (if stdin is a regular file)
+   or read in blocks. Samples are pairs of little-endian 16 bit words;
+   on big-endian hosts they are read in blocks and byte-swapped. */
+struct input {
+    FILE *f;
+    int swap;
+    uint16_t *buf;
+    const uint16_t *data;   /* next sample */
+    size_t avail;           /* samples left at data */
+    void *map;
+    size_t map_size;
+};
 
 static int
-read_value(FILE *f, uint32_t *value)
+host_big_endian(void)
+{
+    const uint16_t one = 1;
+    return *(const unsigned char *) &one == 0;
+}
+
+static void
+input_open(struct input *in, FILE *f)
+{
+    memset(in, 0, sizeof(*in));
+    in->f = f;
+    in->swap = host_big_endian();
+#ifdef HAVE_MMAP
+    struct stat st;
+    int fd = fileno(f);
+    off_t start = lseek(fd, 0, SEEK_CUR);
+    if (!in->swap && fstat(fd, &st) == 0 && S_ISREG(st.st_mode) &&
+        start >= 0 && st.st_size > start) {
+        in->map_size = st.st_size;
+        in->map = mmap(NULL, in->map_size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (in->map == MAP_FAILED) {
+            in->map = NULL;
+        } else {
+            posix_madvise(in->map, in->map_size, POSIX_MADV_SEQUENTIAL);
+            in->data = (const uint16_t *) ((const char *) in->map + start);
+            in->avail = (in->map_size - start) / (2*sizeof(uint16_t));
+            return;
+        }
+    }
+#endif
+    in->buf = malloc(BLOCK_SAMPLES * 2*sizeof(uint16_t));
+    if (in->buf == NULL) {
+        fprintf(stderr, "Unable to allocate memory.\n");
+        exit(EXIT_FAILURE);
+    }
+}
+
+/* Make up to max samples available at *data and return their number */
+static size_t
+input_next(struct input *in, const uint16_t **data, size_t max)
 {
-    uint16_t sample[2];
-    size_t rd = fread(sample, sizeof(uint16_t), 2, f);
-    if (rd < 2) {
-        if (feof(f)) return 0;
-        return -1;
+    if (in->avail == 0 && in->map == NULL) {
+        size_t rd = fread(in->buf, 2*sizeof(uint16_t), BLOCK_SAMPLES, in->f);
+        if (rd == 0) {
+            if (ferror(in->f)) {
+                perror("fread");
+                exit(EXIT_FAILURE);
+            }
+            fprintf(stderr, "Unexpected EOF.\n");
+            exit(EXIT_FAILURE);
+        }
+        if (in->swap) {
+            for (size_t i = 0; i < 2*rd; i++) {
+                in->buf[i] = (uint16_t) (in->buf[i] << 8 | in->buf[i] >> 8);
+            }
+        }
+        in->data = in->buf;
+        in->avail = rd;
+    } else if (in->avail == 0) {
+        fprintf(stderr, "Unexpected EOF.\n");
+        exit(EXIT_FAILURE);
+    }
+    size_t n = max < in->avail ? max : in->avail;
+    *data = in->data;
+    in->data += 2*n;
+    in->avail -= n;
+    return n;
+}
+
+static uint32_t
+sample_value(const uint16_t *sample)
+{
+    return ((uint32_t) sample[1] << 16) | sample[0];
+}
+
+/* Add n samples to the sum and base ARCF of one track and the CRCv2 of
+   another. Weights start at w1 and w2. This is where almost all the time
+   is spent, so it is kept free of branches for the compiler to vectorize. */
+static void
+sum_samples(const uint16_t *restrict samples, size_t n,
+            uint32_t w1, uint32_t w2,
+            uint32_t *restrict sum, uint32_t *restrict arcf,
+            uint32_t *restrict crc2)
+{
+    uint32_t s = 0, a = 0, lo = 0, hi = 0;
+    for (size_t i = 0; i < n; i++) {
+        uint32_t value = ((uint32_t) samples[2*i+1] << 16) | samples[2*i];
+        uint64_t calcvalue = (uint64_t) value * (w2 + (uint32_t) i);
+        s += value;
+        a += value * (w1 + (uint32_t) i);
+        lo += (uint32_t) calcvalue;
+        hi += (uint32_t) (calcvalue >> 32);
     }
-    *value = (sample[1] << 16) | sample[0];
-    return rd;
+    *sum += s;
+    *arcf += a;
+    *crc2 += lo + hi;
 }
 
 static void
@@ -40,7 +203,7 @@ update_arcf(uint32_t *restrict arcf, uint32_t *restrict sum,
         /* Save first values of track in ARCF block.
            This is the value we'll need later when
            calculating the derived ARCFs. */
-        if (tr < ARCFS_PER_TRACK-1) {
+        if (tr < arcfs_per_track-1) {
             arcf[ARCF_IDX(track, tr+1)] = value;
         }
 
@@ -51,7 +214,7 @@ update_arcf(uint32_t *restrict arcf, uint32_t *restrict sum,
 
     /* Calculate derived ARCFs for previous track
        (so skip if this is the first track). */
-    if (track > 0 && tr < ARCFS_PER_TRACK-1) {
+    if (track > 0 && tr < arcfs_per_track-1) {
         /* Fetch saved value */
         uint32_t first = arcf[ARCF_IDX(track-1, tr+1)];
 
@@ -113,6 +276,32 @@ alloc_int(size_t nmemb, void *to_free, int n)
     return (int *) alloc_memory(nmemb, sizeof(int), to_free, n);
 }
 
+/* Write the ARCFs, ARCF450s and CRCv2 of a track in binary mode */
+static void
+write_track(int trackno, const uint32_t *arcf, const uint32_t *arcf450,
+            const uint32_t *crc2)
+{
+    fwrite(&arcf[ARCF_IDX(trackno, 0)], sizeof(uint32_t), arcfs_per_track,
+           stdout);
+    fwrite(&arcf450[ARCF_IDX(trackno, 0)], sizeof(uint32_t),
+           arcfs_per_track, stdout);
+    fwrite(&crc2[trackno], sizeof(uint32_t), 1, stdout);
+    if (fflush(stdout) != 0) {
+        perror("fwrite");
+        exit(EXIT_FAILURE);
+    }
+}
+
+static void
+usage(void)
+{
+    fprintf(stderr,
+            "usage: ckcdda [-r radius] num_pairs_per_track length(0) "
+            "crc(0,0)... crc450(0,0)... length(1)...\n"
+            "       ckcdda [-r radius] -b length(0) length(1)...\n");
+    exit(EXIT_FAILURE);
+}
+
 int
 main(int argc, char *argv[])
 {
@@ -122,145 +311,260 @@ main(int argc, char *argv[])
         exit(EXIT_FAILURE);
     }
 
-    if (argc < 2) {
-        fprintf(stderr, "Need at least two arguments\n");
+    /* With -b, no database entries are given and all ARCFs are written
+       to stdout in binary form instead. */
+    int binary = 0;
+    int argi = 1;
+    while (argi < argc && argv[argi][0] == '-') {
+        if (strcmp(argv[argi], "-b") == 0) {
+            binary = 1;
+            argi += 1;
+        } else if (strcmp(argv[argi], "-r") == 0 && argi+1 < argc) {
+            radius = atoi(argv[argi+1]);
+            argi += 2;
+        } else {
+            usage();
+        }
+    }
+    if (radius < 0 || radius > MAX_RADIUS) {
+        fprintf(stderr, "Radius must be between 0 and %i\n", MAX_RADIUS);
+        exit(EXIT_FAILURE);
+    }
+    arcfs_per_track = 2*radius+1;
+
+    if (argi+(binary ? 0 : 1) >= argc)
+        usage();
+    if (binary && freopen(NULL, "wb", stdout) == NULL) {
+        perror("freopen");
         exit(EXIT_FAILURE);
     }
 
-    int num_pairs_per_track = atoi(argv[1]); /* number of (crc, crc450) pairs per
-                                                track */
-    int track_count = (argc-2) / (num_pairs_per_track*2 + 1);
-    if ( (argc-2) % (num_pairs_per_track*2 + 1) ) {
+    int num_pairs_per_track = binary ? 0 : atoi(argv[argi++]); /* number of
+                                                                  (crc,
+                                                                  crc450)
+                                                                  pairs per
+                                                                  track */
+    int track_count = (argc-argi) / (num_pairs_per_track*2 + 1);
+    if ( (argc-argi) % (num_pairs_per_track*2 + 1) ) {
         fprintf(stderr, "Invalid number of arguments\n");
         exit(EXIT_FAILURE);
     }
 
-    printf("track count: %i\n", track_count);
-    printf("entries per track: %i\n", num_pairs_per_track);
+    if (!binary) {
+        printf("track count: %i\n", track_count);
+        printf("entries per track: %i\n", num_pairs_per_track);
+    }
+
+    /* Hash sets hold at most half of their slots */
+    uint32_t set_size = 1;
+    while (set_size < 2*(uint32_t) (track_count*num_pairs_per_track+1))
+        set_size <<= 1;
 
-    void     *to_alloc[8] = {NULL};
+    void     *to_alloc[10] = {NULL};
     int      *length = alloc_int(track_count+1, to_alloc, 0);
     uint32_t *sum = alloc_uint32(track_count, to_alloc, 1);
     uint32_t *crc2 = alloc_uint32(track_count, to_alloc, 2);
-    uint32_t *arcf = alloc_uint32(track_count*ARCFS_PER_TRACK, to_alloc, 3);
-    uint32_t *arcf450 = alloc_uint32(track_count*ARCFS_PER_TRACK, to_alloc, 4);
+    uint32_t *arcf = alloc_uint32(track_count*arcfs_per_track, to_alloc, 3);
+    uint32_t *arcf450 = alloc_uint32(track_count*arcfs_per_track, to_alloc, 4);
     uint32_t *frame = alloc_uint32(SAMPLES_PER_FRAME, to_alloc, 5);
-    uint32_t *dbcrc = alloc_uint32(track_count*num_pairs_per_track,
-                                   to_alloc, 6);
-    uint32_t *dbcrc450 = alloc_uint32(track_count*num_pairs_per_track,
-                                      to_alloc, 7);
+    struct crc_set dbcrc = {
+        alloc_uint32(set_size, to_alloc, 6),
+        alloc_int(set_size, to_alloc, 7),
+        set_size-1
+    };
+    struct crc_set dbcrc450 = {
+        alloc_uint32(set_size, to_alloc, 8),
+        alloc_int(set_size, to_alloc, 9),
+        set_size-1
+    };
+    memset(dbcrc.track, -1, set_size*sizeof(int));
+    memset(dbcrc450.track, -1, set_size*sizeof(int));
 
     /* args layout:
        ./ckcdda num_pairs_per_track length(0) crc(0,0) crc(0,1)...
        crc450(0,0) crc450(0,1)... length(1) crc(1,0) crc(1,1)...
-       crc450(1,0) crc450(1,1)... length(2)... */
+       crc450(1,0) crc450(1,1)... length(2)...
+       or
+       ./ckcdda -b length(0) length(1) length(2)...
+       optionally preceded by -r radius */
     int total_length = 0;
     for (int trackno = 0; trackno < track_count; trackno++) {
-        int p = 2+trackno*(2*num_pairs_per_track+1);
+        int p = argi+trackno*(2*num_pairs_per_track+1);
         length[trackno] = atoi(argv[p])*SAMPLES_PER_FRAME;
 
         /* Read in dbcrc and dbcrc450 */
         for (int j = 0, k = num_pairs_per_track; j < num_pairs_per_track;
              j++, k++) {
-            dbcrc[trackno*num_pairs_per_track + j] = atoi(argv[p+j+1]);
-            dbcrc450[trackno*num_pairs_per_track + j] = atoi(argv[p+k+1]);
+            crc_set_add(&dbcrc, strtoul(argv[p+j+1], NULL, 0), trackno);
+            crc_set_add(&dbcrc450, strtoul(argv[p+k+1], NULL, 0), trackno);
         }
 
         total_length += length[trackno];
     }
-    printf("total_length: %i\n", total_length);
+    if (!binary)
+        printf("total_length: %i\n", total_length);
+
+    /* The derived ARCFs of a track are calculated while reading the
+       first 2*radius samples of the next, and the first 2*radius samples
+       of its window are kept until then. */
+    for (int trackno = 0; trackno < track_count; trackno++) {
+        if (length[trackno] - (trackno == 0 ? SKIP_FIRST : 0) -
+            (trackno == track_count-1 ? SKIP_LAST : 0) < 2*radius) {
+            fprintf(stderr, "Track %i too short for radius %i\n", trackno,
+                    radius);
+            exit(EXIT_FAILURE);
+        }
+    }
 
-    length[track_count-1] -= CHECK_RADIUS+1;
-    length[track_count] = 2*CHECK_RADIUS+1;
+    length[track_count-1] -= SKIP_LAST;
+    length[track_count] = 2*radius+1;
 
-    for (int i = 0; i < track_count+1; i++)
-        printf("len(%i): %i\n", i, length[i]);
+    if (!binary)
+        for (int i = 0; i < track_count+1; i++)
+            printf("len(%i): %i\n", i, length[i]);
 
     int track = 0;
-    printf("At track %u (%u, %u)\n", track, track < track_count, track > 0);
-
-    int ti = CHECK_RADIUS;
+    if (!binary)
+        printf("At track %u (%u, %u)\n", track, track < track_count,
+               track > 0);
+
+    /* The stream starts radius samples before the window of the first
+       track at offset 0 and ends radius samples after the window of the
+       last track. pos is the position in the album of the first sample
+       of the stream; anything outside the album is silence. */
+    int pos = SKIP_FIRST - radius;
+    int stream_length = total_length - SKIP_FIRST - SKIP_LAST + 2*radius+1;
+
+    int ti = SKIP_FIRST;
     int tr = 0;
     int di = 0;
 
-    int ti2 = 0;
+    int ti2 = pos > 0 ? pos : 0;
     int track2 = 0;
     uint32_t framesum = 0; /* sum of all audio vales in current frame */
     uint32_t framecrc = 0; /* v1 CRC of current frame */
 
+    /* Frame CRCs are only needed for the frames around frame 450 */
+    int frame_start = 450*SAMPLES_PER_FRAME - radius;
+    int frame_end = 451*SAMPLES_PER_FRAME + radius;
+
+    struct input in;
+    const uint16_t *samples;
+    input_open(&in, stdin);
+
+    /* Skip the start of the album if the radius is small */
+    for (size_t skip = pos > 0 ? pos : 0; skip > 0; )
+        skip -= input_next(&in, &samples, skip);
+
     int last_tr = 0;
-    while (di < total_length) {
-        /* Read one stereo sample */
-        uint32_t value;
-        int r = read_value(stdin, &value);
-        if (r == 0) {
-            fprintf(stderr, "Unexpected EOF.\n");
-            exit(EXIT_FAILURE);
-        } else if (r < 0) {
-            perror("read_value");
-            exit(EXIT_FAILURE);
-        }
+    int written = 0; /* tracks written in binary mode */
+    while (di < stream_length) {
+        int p = pos + di;
+
+        if (p >= SKIP_FIRST && p < total_length && track < track_count &&
+            tr >= arcfs_per_track-1 && track2 < track_count &&
+            (ti2 < frame_start || ti2 >= frame_end)) {
+            /* Samples that only add to the base ARCF of one track and the
+               CRCv2 of another are summed in runs up to the next point
+               where something else happens. */
+            size_t n = MIN(length[track] - ti, length[track2] - ti2);
+            if (ti2 < frame_start)
+                n = MIN(n, (size_t) (frame_start - ti2));
+            n = MIN(n, (size_t) (total_length - p));
+            n = input_next(&in, &samples, n);
+
+            sum_samples(samples, n, ti+1, ti2+1, &sum[track],
+                        &arcf[ARCF_IDX(track, 0)], &crc2[track2]);
+
+            di += n;
+            ti += n;
+            tr += n;
+            ti2 += n;
+        } else {
+            /* Read one stereo sample */
+            uint32_t value = 0;
+            if (p >= 0 && p < total_length) {
+                input_next(&in, &samples, 1);
+                value = sample_value(samples);
+            }
 
-        /* Update ARCF values */
-        update_arcf(arcf, sum, track, track_count, length, ti, tr, last_tr,
-                    value);
-
-        if (di >= CHECK_RADIUS) {
-            uint64_t calcvalue = (uint64_t) value * ((uint64_t) ti2+1);
-            /* Update ARv2 CRC */
-            crc2[track2] += (calcvalue & 0xFFFFFFFF);
-            crc2[track2] += (calcvalue / 0x100000000);
-
-            /* Update frame CRC */
-            int offset = ti2 - (451*SAMPLES_PER_FRAME-1-CHECK_RADIUS);
-            if (offset < ARCFS_PER_TRACK) {
-                update_framecrc(frame, &framesum, &framecrc, ti2, value);
-                if (offset >= 0)
-                    arcf450[ARCF_IDX(track2, offset)] = framecrc;
+            /* Update ARCF values */
+            update_arcf(arcf, sum, track, track_count, length, ti, tr,
+                        last_tr, value);
+
+            if (p >= 0 && track2 < track_count) {
+                if (p >= SKIP_FIRST) {
+                    uint64_t calcvalue = (uint64_t) value * ((uint64_t) ti2+1);
+                    /* Update ARv2 CRC */
+                    crc2[track2] += (calcvalue & 0xFFFFFFFF);
+                    crc2[track2] += (calcvalue / 0x100000000);
+
+                    /* Update frame CRC */
+                    if (ti2 >= frame_start && ti2 < frame_end) {
+                        update_framecrc(frame, &framesum, &framecrc, ti2,
+                                        value);
+                        int offset = ti2 - (451*SAMPLES_PER_FRAME-1-radius);
+                        if (offset >= 0)
+                            arcf450[ARCF_IDX(track2, offset)] = framecrc;
+                    }
+                }
+                ti2 += 1;
             }
-        }
 
-        /* Increment counters */
-        di += 1;
-        ti += 1;
-        tr += 1;
-        ti2 += 1;
+            /* Increment counters */
+            di += 1;
+            ti += 1;
+            tr += 1;
+        }
 
         /* Check whether end of current track has been reached. */
+        if (track2 < track_count && ti2 == length[track2]) {
+            ti2 = 0;
+            framesum = 0;
+            framecrc = 0;
+            memset(frame, 0, SAMPLES_PER_FRAME * sizeof(uint32_t));
+            track2 += 1;
+        }
         if (ti == length[track]) {
             last_tr = tr;
             ti = 0;
             tr = 0;
             track += 1;
-            printf("At %i track %i (%u, %u)\n", di, track, track < track_count,
-                   track > 0);
+            if (!binary)
+                printf("At %i track %i (%u, %u)\n", di, track,
+                       track < track_count, track > 0);
         }
-        if (ti2 == length[track2]) {
-            ti2 = 0;
-            framesum = 0;
-            framecrc = 0;
-            memset(frame, 0, SAMPLES_PER_FRAME * sizeof(uint32_t));
-            track2 += 1;
+
+        /* The ARCFs of the previous track are final once its derived
+           ARCFs have been calculated, its CRCv2 and frame CRCs are done
+           by then. Write them right away, so the caller can report the
+           track without waiting for the rest of the disc. */
+        if (binary && track > 0 && tr == arcfs_per_track-1 &&
+            written < track && written < track_count) {
+            write_track(written, arcf, arcf450, crc2);
+            written++;
         }
     }
 
+    /* Write the tracks whose ARCFs weren't final before the end */
+    if (binary) {
+        for (; written < track_count; written++)
+            write_track(written, arcf, arcf450, crc2);
+        return EXIT_SUCCESS;
+    }
+
     /* Print ARCFs for offset 0 and matching offsets */
     for (int trackno = 0; trackno < track_count; trackno++) {
-        for (int o = 0; o < ARCFS_PER_TRACK; o++) {
-            int offset = o-CHECK_RADIUS;
+        for (int o = 0; o < arcfs_per_track; o++) {
+            int offset = o-radius;
             uint32_t crc = arcf[ARCF_IDX(trackno, o)];
             uint32_t crc450 = arcf450[ARCF_IDX(trackno, o)];
             if (offset == 0) {
                 printf("%03u,%i: %08X %08X %08X\n", trackno,
-                       o-CHECK_RADIUS, crc, crc450, crc2[trackno]);
-            } else {
-                for (int j = 0; j < num_pairs_per_track; j++) {
-                    if (crc == dbcrc[trackno*num_pairs_per_track+j] ||
-                        crc450 == dbcrc450[trackno*num_pairs_per_track+j]) {
-                        printf("%03u,%i: %08X %08X\n", trackno, o-CHECK_RADIUS,
-                               crc, crc450);
-                    }
-                }
+                       offset, crc, crc450, crc2[trackno]);
+            } else if (crc_set_contains(&dbcrc, crc, trackno) ||
+                       crc_set_contains(&dbcrc450, crc450, trackno)) {
+                printf("%03u,%i: %08X %08X\n", trackno, offset, crc, crc450);
             }
         }
     }
@@ -0,0 +1,132 @@
+"""CUE sheet support
+
+Turns a CUE sheet into virtual tracks: (path, start, num_samples) ranges of
+the files it references, so that an image rip can be checksummed as one
+decode stream without splitting it. As accuraterip expects, the pregap of a
+track (its INDEX 00 to INDEX 01) belongs to the previous track; audio before
+INDEX 01 of the first track (a hidden track) is left out and counted as
+additional pregap sectors instead. A PREGAP (silence left out of the image)
+is only supported on the first track.
+"""
+import shlex
+from os.path import basename, dirname, exists, join, splitext
+
+import utils
+from utils import CueError, SAMPLES_PER_FRAME, AUDIO_EXTENSIONS
+
+def is_cue(paths):
+    return len(paths) == 1 and paths[0].lower().endswith('.cue')
+
+def msf_frames(value):
+    m, s, f = [int(x) for x in value.split(':')]
+    return (m*60 + s)*75 + f
+
+def find_file(cue_path, name):
+    """Path of a file referenced by cue_path
+
+    Rippers often name the image as it was before it was compressed, so a
+    file with the same name and another audio extension is accepted too.
+    """
+    name = name.replace('\\', '/')
+    for path in (join(dirname(cue_path), name),
+                 join(dirname(cue_path), basename(name))):
+        if exists(path):
+            return path
+        stem = splitext(path)[0]
+        for ext in AUDIO_EXTENSIONS:
+            if exists(stem + ext):
+                return stem + ext
+    raise CueError('%s: file %s not found' % (cue_path, name))
+
+def parse(path):
+    """Return the audio tracks of the CUE sheet at path
+
+    Every track is a dict with number, path (of the file holding INDEX
+    01), index (INDEX 01 in frames) and pregap (PREGAP in frames).
+    """
+    tracks = []
+    data_tracks = 0
+    filename = None
+    track = None
+    with open(path, 'rb') as f:
+        text = f.read()
+    for encoding in ('utf-8-sig', 'latin-1'):
+        try:
+            text = text.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            pass
+
+    for n, line in enumerate(text.splitlines(), start=1):
+        try:
+            words = shlex.split(line, posix=True)
+        except ValueError:
+            words = line.split()
+        if not words:
+            continue
+        command = words[0].upper()
+        try:
+            if command == 'FILE':
+                filename = find_file(path, words[1])
+            elif command == 'TRACK':
+                if words[2].upper() != 'AUDIO':
+                    data_tracks += 1
+                    track = None
+                    continue
+                if data_tracks:
+                    raise CueError('%s: data track before audio track %s' %
+                                   (path, words[1]))
+                track = dict(number=int(words[1]), path=None, index=None,
+                             pregap=0)
+                tracks.append(track)
+            elif command == 'PREGAP' and track:
+                track['pregap'] = msf_frames(words[1])
+            elif command == 'INDEX' and track and int(words[1]) == 1:
+                track['path'] = filename
+                track['index'] = msf_frames(words[2])
+        except (IndexError, ValueError):
+            raise CueError('%s:%i: malformed line' % (path, n))
+
+    if not tracks:
+        raise CueError('%s: no audio tracks' % path)
+    for track in tracks:
+        if track['path'] is None:
+            raise CueError('%s: track %i has no INDEX 01' %
+                           (path, track['number']))
+    return tracks
+
+def read_tracks(BIN, path):
+    """Return ([(path, start, num_samples, number)], additional sectors)
+    for the CUE sheet at path"""
+    tracks = parse(path)
+    files = []
+    for track in tracks:
+        if track['path'] not in files:
+            files.append(track['path'])
+    lengths = dict(zip(files, utils.probe_num_samples(BIN, files)))
+
+    additional_sectors = tracks[0]['index'] + tracks[0]['pregap']
+    layout = []
+    for i, track in enumerate(tracks):
+        if i and track['pregap']:
+            # silence that isn't in the image, which would have to be
+            # added to the end of the previous track
+            raise CueError('%s: PREGAP of track %i is not in any file' %
+                           (path, track['number']))
+        start = track['index']*SAMPLES_PER_FRAME
+        if i+1 < len(tracks) and tracks[i+1]['path'] == track['path']:
+            end = tracks[i+1]['index']*SAMPLES_PER_FRAME
+        else:
+            end = lengths[track['path']]
+            if i+1 < len(tracks) and tracks[i+1]['index']:
+                # the pregap of the next track would span two files
+                raise CueError('%s: pregap of track %i is in another file '
+                               'than track %i' % (path, tracks[i+1]['number'],
+                                                  track['number']))
+        if end <= start:
+            raise CueError('%s: track %i is empty' % (path, track['number']))
+        layout.append((track['path'], start, end-start, track['number']))
+    return layout, additional_sectors
+
+def track_name(path, number):
+    return '%s (track %02i)' % (basename(path), number)
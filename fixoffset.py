@@ -2,23 +2,31 @@
 from __future__ import print_function
 
 import os
-import sys
 import signal
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen,  PIPE
 from argparse import ArgumentParser
 from os.path import basename, dirname, exists, splitext, join
 
+import arcache
+import arclient
+import arcf
+import armirror
+import arprofile
+import arverify
 import utils
 
 BIN = {'metaflac': None,
        'ffprobe': 'avprobe',
        'sox': None,
+       'ffmpeg': 'avconv',
        'splitaudio': None,
        }
 
 PROGNAME = 'fixoffset'
 VERSION = '0.2'
-REQUIRED = ['ffprope', 'sox', 'splitaudio']
+REQUIRED = ['ffprope', 'splitaudio']
 PROCS = []
 TEMPDIRS = []
 
@@ -34,12 +42,129 @@ def process_arguments():
                         default='wav',
                         choices=['wav', 'flac'],
                         help='format of generated output file(s)')
+    parser.add_argument('-c', '--compression-level', dest='level', type=int,
+                        help='FLAC compression level (0-8)')
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of tracks to encode in parallel",
+                        )
 
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='checksum the fixed tracks while writing them '
+                        'and only keep them if they match accuraterip '
+                        '(needs numpy)')
+    arcache.add_cache_arguments(parser)
+    arclient.add_client_arguments(parser)
+    armirror.add_mirror_arguments(parser)
+    arprofile.add_profile_arguments(parser)
+    utils.add_decode_arguments(parser)
     utils.add_common_arguments(parser, VERSION)
 
-    return parser.parse_args()
+    options = parser.parse_args()
+    if options.offline and not options.cache:
+        parser.error('--offline requires the cache')
+    arclient.check_client_options(parser, options)
+    if options.level is not None and not 0 <= options.level <= 8:
+        parser.error('--compression-level must be between 0 and 8')
+    if options.level is not None and options.format != 'flac':
+        parser.error('--compression-level requires flac output')
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if options.decode_jobs < 1:
+        parser.error('--decode-jobs must be at least 1')
 
-def fix_offset(sources, offset, fmt='wav', verbose=False):
+    return options
+
+def output_path(output_dir, source, fmt):
+    return join(output_dir,
+                '%s.%s' % (splitext(basename(source['path']))[0], fmt))
+
+def track_engine(sources, index, verify):
+    """Checksum engine positioned at track index of the fixed rip, or None"""
+    if not verify:
+        return None
+    lengths = [s['num_samples'] for s in sources]
+    return arcf.ARCFEngine(lengths, sum(lengths[:index]))
+
+def tee(blocks, engine):
+    for block in blocks:
+        with utils.profile_stage('checksum', len(block)):
+            engine.update(block)
+        yield block
+
+def encode_track(args):
+    """Pool job: write track index of the album moved by offset samples
+
+    The track is read straight from the sources at its shifted position,
+    so every job decodes and encodes independently. With verify the
+    samples are checksummed on their way to splitaudio. The sources the
+    track spans are decoded decode_jobs at a time. Returns index and the
+    checksum states.
+    """
+    sources, offset, index, fmt, level, output_dir, verify, progress, \
+        decode_jobs = args
+    files = [(s['path'], s['num_samples']) for s in sources]
+    start = sum(s['num_samples'] for s in sources[:index]) + offset
+    length = sources[index]['num_samples']
+    engine = track_engine(sources, index, verify)
+
+    splitaudio_args = [BIN['splitaudio'], '-n', str(index)]
+    if level is not None:
+        splitaudio_args += ['-l', str(level)]
+    splitaudio_args += ['1' if fmt == 'flac' else '0', str(length)]
+    PROCS.append(Popen(splitaudio_args, stdin=PIPE, cwd=output_dir))
+    blocks = utils.album_blocks(BIN, files, start, length, PROCS,
+                                decode_jobs)
+    if engine:
+        blocks = tee(blocks, engine)
+    returncode = utils.write_blocks(PROCS[-1], blocks, progress)
+    if returncode:
+        raise utils.SubprocessError('splitaudio had an error (returned %i)' %
+                                    returncode)
+
+    return index, engine.states() if engine else {}
+
+def copy_track(args):
+    """Pool job: like encode_track, but for WAV output from WAV/raw sources
+
+    Moving the offset only shifts the PCM data, so it is copied straight
+    from the sources (by the kernel where possible) after a new header.
+    """
+    sources, mapped, offset, index, output_dir, verify, progress = args
+    files = [(s['path'], s['num_samples']) for s in sources]
+    start = sum(s['num_samples'] for s in sources[:index]) + offset
+    length = sources[index]['num_samples']
+    engine = track_engine(sources, index, verify)
+
+    src = join(output_dir, 'fixed%03i.wav' % index)
+    with open(src, 'wb') as out:
+        utils.write_wav_header(out, length)
+        for i, a, n in utils.album_ranges(files, start, length):
+            size = n*utils.BYTES_PER_SAMPLE
+            if i is None:
+                out.write(b'\0'*size)
+            else:
+                with open(mapped[i].path, 'rb') as f, \
+                        utils.profile_stage('copy', size):
+                    utils.copy_range(f, out, mapped[i].offset +
+                                     a*utils.BYTES_PER_SAMPLE, size)
+            progress.update(n)
+
+    if engine:
+        for block in utils.album_blocks(BIN, files, start, length):
+            with utils.profile_stage('checksum', len(block)):
+                engine.update(block)
+    return index, engine.states() if engine else {}
+
+def fix_offset(sources, offset, fmt='wav', level=None, jobs=1, engine=None,
+               verbose=False, decode_jobs=1):
+    """Write the tracks moved by offset samples to a new directory
+
+    The tracks keep temporary names until rename_tracks is called. If
+    engine is given, the checksums of the fixed tracks are merged into it.
+    jobs tracks are written at a time, each decoding up to decode_jobs of
+    its sources ahead.
+    """
     output_dir = None
     i = 0
     while not output_dir:
@@ -51,55 +176,71 @@ def fix_offset(sources, offset, fmt='wav', verbose=False):
         i += 1
     TEMPDIRS.append(output_dir)
     os.mkdir(output_dir)
-    common_args = ['-t', 'raw',
-                   '-b16',
-                   '-c2',
-                   '-r44100',
-                   '-e', 'signed-integer',
-                   '-',
-                   ]
-    sox_args = [BIN['sox']]+[s['path'] for s in sources]+common_args
-
-    total_samples = sum([s['num_samples'] for s in sources])
-    if offset > 0:
-        sox_args += ['pad', '0', '%is' % offset,
-                     'trim', '%is' % offset, '%is' % total_samples]
-    else:
-        sox_args += ['pad', '%is' % -offset, '0',
-                     'trim', '0', '%is' % total_samples]
-
-    splitaudio_args = [BIN['splitaudio'], '1' if fmt == 'flac' else '0']
-
-    for s in sources:
-        splitaudio_args += [str(s['num_samples'])]
 
+    verify = engine is not None
+    progress = utils.Progress('fixoffset', 'Fixing offset (%i samples)' %
+                              offset, sum(s['num_samples'] for s in sources))
+    mapped = [utils.open_audio(BIN, s['path']) for s in sources]
+    if fmt == 'wav' and all(isinstance(m, utils.MappedFile) for m in mapped):
+        job = copy_track
+        args = [(sources, mapped, offset, i, output_dir, verify, progress)
+                for i in range(len(sources))]
+    else:
+        job = encode_track
+        args = [(sources, offset, i, fmt, level, output_dir, verify,
+                 progress, decode_jobs)
+                for i in range(len(sources))]
     if verbose:
-        print('format: %s' % fmt)
-        print('%s | %s' % (' '.join(sox_args), ' '.join(splitaudio_args)))
-    devnull = open(os.devnull, 'w')
-    PROCS.append(Popen(sox_args, stdout=PIPE, stderr=devnull))
-    PROCS.append(Popen(splitaudio_args, stdin=PROCS[-1].stdout, cwd=output_dir))
-
-    p = PROCS[-1]
-    while p.poll() is None:
-        utils.show_status('Fixing offset (%i samples)', offset)
-
-    out, err = p.communicate()
-    devnull.close()
-    print('', file=sys.stderr, end='\n')
-    for pr in PROCS:
-        if pr.returncode:
-            raise utils.SubprocessError('sox had an error (returned %i)' %
-                                        pr.returncode)
+        print('format: %s%s' % (fmt, ' (copying PCM data)'
+                                if job == copy_track else ''))
+    # the work is done by splitaudio and the decoders, so threads will do
+    pool = ThreadPool(jobs)
+    try:
+        for index, states in pool.imap_unordered(job, args):
+            if verify:
+                engine.merge(states)
+    except:
+        # unblock the jobs still feeding splitaudio before joining them
+        for p in PROCS:
+            try: p.kill()
+            except OSError: pass
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    progress.finish()
 
-    TEMPDIRS.remove(output_dir)
+    return output_dir
+
+def rename_tracks(sources, output_dir, fmt='wav'):
+    """Give the fixed tracks their final names"""
     for i, s in enumerate(sources):
-        src = join(output_dir, 'fixed%03i.%s' % (i,fmt))
-        outpath = join(output_dir,
-                       '%s.%s' % (splitext(basename(s['path']))[0], fmt))
-        os.rename(src, outpath)
+        src = join(output_dir, 'fixed%03i.%s' % (i, fmt))
+        os.rename(src, output_path(output_dir, s, fmt))
+    TEMPDIRS.remove(output_dir)
 
-    return output_dir
+def verify_output(tracks, engine, fetch, verbose=False):
+    """Match the checksums of the fixed rip and print arverify's summary
+
+    Raises AccurateripError, which discards the output, unless every track
+    matches the database exactly at offset 0: a match at another offset
+    means the offset was fixed by the wrong amount, and a disc that isn't
+    in the database can't be verified at all. Lookup errors are raised
+    as well.
+    """
+    arcfs, arcf450s, crc2s = engine.results()
+    fetch.result()
+    arverify.match_tracks(tracks, arcfs.tolist(), arcf450s.tolist(),
+                          crc2s.tolist())
+    arverify.print_summary(tracks, verbose)
+    if not any(t.num_submissions for t in tracks):
+        raise utils.AccurateripError('disc not in database, output '
+                                     'discarded')
+    bad = sum(1 for t in tracks if 0 not in t.exact_matches)
+    if bad:
+        raise utils.AccurateripError('%i fixed track%s not accurate at '
+                                     'offset 0, output discarded' %
+                                     (bad, 's' if bad != 1 else ''))
 
 def print_summary(sources, output_dir):
     s = 's' if len(sources) > 1 else ''
@@ -109,17 +250,48 @@ def main(options):
     utils.check_dependencies(BIN, REQUIRED)
     sources = [dict(path=p) for p in options.paths]
 
-    for s in sources:
-        s['num_samples'] = utils.get_num_samples(BIN, s['path'])
+    with utils.profile_stage('probe'):
+        counts = utils.probe_num_samples(BIN, options.paths)
+    for s, num_samples in zip(sources, counts):
+        s['num_samples'] = num_samples
         if s['num_samples'] % 588 != 0:
             msg = "%s not from CD (%i samples)\n" % (s['path'],
                                                      s['num_samples'])
             raise utils.NotFromCDError(msg)
-    output_dir = fix_offset(sources, options.offset, options.format,
-                            options.verbose)
+
+    engine = None
+    if options.verify:
+        arcf.check_numpy()
+        arverify.CACHE = arcache.from_options(options)
+        arverify.CLIENT = arclient.from_options(options)
+        arverify.MIRROR = armirror.from_options(options)
+        tracks = [arverify.Track(s['path'], s['num_samples'])
+                  for s in sources]
+        cddb, id1, id2 = arverify.get_disc_ids(tracks)
+        fetch = utils.BackgroundCall(arverify.get_ar_entries, cddb, id1, id2,
+                                     tracks, options.verbose)
+        engine = arcf.ARCFEngine(counts)
+
+    with utils.profile_stage('fixoffset'):
+        output_dir = fix_offset(sources, options.offset, options.format,
+                                options.level, options.jobs, engine,
+                                options.verbose, options.decode_jobs)
+    if options.verify:
+        # the summary names the fixed files, not the sources
+        for track, s in zip(tracks, sources):
+            track.path = track.name = output_path(output_dir, s,
+                                                  options.format)
+        print('Disc ID: %08x-%08x-%08x' % (id1, id2, cddb))
+        with utils.profile_stage('verify'):
+            try:
+                verify_output(tracks, engine, fetch, options.verbose)
+            finally:
+                arverify.CLIENT.close()
+    rename_tracks(sources, output_dir, options.format)
     print_summary(sources, output_dir)
 
     return 0
 
 if __name__ == '__main__':
-    utils.execute(main, process_arguments, PROCS, tempdirs=TEMPDIRS)
+    utils.execute(arprofile.profiled(main, PROGNAME), process_arguments,
+                  PROCS, tempdirs=TEMPDIRS)
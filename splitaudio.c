@@ -9,10 +9,38 @@
 #define MIN(a,b) ((a) < (b) ? a : b)
 #define BUFSIZE 16*1024
 
+static void
+usage(void)
+{
+    fprintf(stderr,
+            "usage: splitaudio [-n first_index] [-l flac_level] "
+            "format length(0) length(1)...\n");
+    exit(EXIT_FAILURE);
+}
+
 int
 main(int argc, char *argv[])
 {
-    int track_count = argc-2;
+    int first_index = 0;
+    double level = -1;
+
+    int argi = 1;
+    while (argi < argc && argv[argi][0] == '-') {
+        if (strcmp(argv[argi], "-n") == 0 && argi+1 < argc) {
+            first_index = atoi(argv[argi+1]);
+            argi += 2;
+        } else if (strcmp(argv[argi], "-l") == 0 && argi+1 < argc) {
+            /* FLAC levels 0-8 map to libsndfile's 0.0-1.0 */
+            level = atoi(argv[argi+1])/8.0;
+            argi += 2;
+        } else {
+            usage();
+        }
+    }
+    if (argi >= argc || first_index < 0 || first_index > 999)
+        usage();
+
+    int track_count = argc-argi-1;
     if (track_count == 0)
         return EXIT_SUCCESS;
 
@@ -28,22 +56,22 @@ main(int argc, char *argv[])
     }
 
     short buf[BUFSIZE*2];
-    int format = atoi(argv[1]);
+    int format = atoi(argv[argi]);
 
     for (int i = 0; i < track_count; i++) {
-        int track_length = atoi(argv[i+2]);
+        int track_length = atoi(argv[argi+i+1]);
 
         SF_INFO out_info = {0};
         out_info.channels = 2;
         out_info.frames = track_length;
         out_info.samplerate = 44100;
 
-        char filename[14];
+        char filename[16];
         if (format == 1) {
-            sprintf(filename, "fixed%03u.flac", i);
+            sprintf(filename, "fixed%03u.flac", first_index+i);
             out_info.format = SF_FORMAT_FLAC | SF_FORMAT_PCM_16;
         } else {
-            sprintf(filename, "fixed%03u.wav", i);
+            sprintf(filename, "fixed%03u.wav", first_index+i);
             out_info.format = SF_FORMAT_WAV | SF_FORMAT_PCM_16;
         }
 
@@ -54,6 +82,9 @@ main(int argc, char *argv[])
                     sf_strerror(outfile));
             return EXIT_FAILURE;
         }
+        if (format == 1 && level >= 0)
+            sf_command(outfile, SFC_SET_COMPRESSION_LEVEL, &level,
+                       sizeof(level));
         int r;
         for (int j = 0; j < track_length; j+=BUFSIZE) {
             int num_to_read = MIN(BUFSIZE, track_length-j);
@@ -2,11 +2,27 @@ from __future__ import print_function
 
 import os
 import sys
+import errno
 import signal
 import re
 import time
+import mmap
+import struct
+import threading
+import multiprocessing
+from contextlib import contextmanager
 
-from os.path import dirname
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from os.path import basename, dirname, splitext
 from fnmatch import fnmatch
 from shutil import rmtree
 from argparse import ArgumentTypeError
@@ -25,6 +41,12 @@ class SubprocessError(Exception):
     """raised when a subprocess has a nonzero return code"""
 class NetworkError(Exception):
     """raised when problem connecting to accuraterip database"""
+class DecodeError(Exception):
+    """raised when an audio file can't be decoded"""
+class CueError(Exception):
+    """raised when a CUE sheet can't be used"""
+class MirrorError(Exception):
+    """raised when a database mirror file can't be used"""
 
 STATUSES = ['[+----]',
             '[-+---]',
@@ -37,6 +59,25 @@ STATUSES = ['[+----]',
             ]
 STATUS_INDEX = 0
 
+# samples are 16 bit signed little endian stereo
+BYTES_PER_SAMPLE = 4
+SAMPLES_PER_FRAME = 588
+BLOCK_SAMPLES = 1 << 18
+SOX_RAW_ARGS = ['-t', 'raw', '-b16', '-c2', '-r44100', '-e', 'signed-integer',
+                '-L']
+WAV_EXTENSIONS = ['.wav', '.wave']
+RAW_EXTENSIONS = ['.raw', '.pcm', '.cdda']
+# files taken for the tracks of a disc
+AUDIO_EXTENSIONS = ['.flac', '.wav', '.ape', '.wv', '.m4a', '.tta', '.aif',
+                    '.aiff']
+PROBE_JOBS = 8
+# blocks buffered per track decoded ahead by ordered_blocks
+DECODE_BUFFER = 4
+STATUS_INTERVAL = 0.25
+PROGRESS_INTERVAL = 5
+QUIET = False
+PROFILE = None  # arprofile.Profiler while --profile is on
+
 def which(name, flags=os.X_OK, additional_paths=[]):
     """Search PATH for executable files with the given name.
 
@@ -81,6 +122,28 @@ def isfile(value):
 
     return value
 
+def isdir(value):
+    if not os.path.isdir(value):
+        raise ArgumentTypeError('%s is not a directory' % value)
+
+    return value
+
+def int_ranges(value):
+    """argparse type for lists like 0-10,33,150"""
+    values = []
+    try:
+        for part in value.split(','):
+            if '-' in part[1:]:
+                first, last = part.split('-', 1)
+                values.extend(range(int(first), int(last)+1))
+            else:
+                values.append(int(part))
+    except ValueError:
+        raise ArgumentTypeError('%s is not a list of numbers and ranges' %
+                                value)
+
+    return values
+
 def check_dependencies(BIN, REQUIRED):
     for dep in BIN:
         value = which(dep, additional_paths=[dirname(sys.argv[0])])
@@ -90,6 +153,7 @@ def check_dependencies(BIN, REQUIRED):
         if not value and not altvalue:
             if dep in REQUIRED:
                 raise DependencyError("%s required\n" % dep)
+            BIN[dep] = None
         else:
             BIN[dep] = altvalue[0] if altvalue else value[0]
 
@@ -107,22 +171,116 @@ def add_common_arguments(parser, version):
                         help=("wait for [ENTER] key press before exiting"),
                         )
 
-def show_status(msg, *args):
+def add_decode_arguments(parser):
+    parser.add_argument("--decode-jobs", dest="decode_jobs", type=int,
+                        default=multiprocessing.cpu_count(), metavar='N',
+                        help="decode up to N tracks ahead in parallel, "
+                        "buffering at most %i MiB of each (default: "
+                        "%%(default)s)" % (DECODE_BUFFER*BLOCK_SAMPLES *
+                                           BYTES_PER_SAMPLE >> 20),
+                        )
+
+def is_tty():
+    try:
+        return sys.stderr.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def update_status(msg, *args):
+    """Show msg on the status line; nothing is written unless stderr is a
+    terminal, logs get Progress lines instead"""
     global STATUS_INDEX
+    if QUIET or not is_tty():
+        return
     status = STATUSES[STATUS_INDEX%len(STATUSES)]
     msg = msg % args
     msg = '\r'+msg+' %s   ' % status
     sys.stderr.write(msg)
     sys.stderr.flush()
-    time.sleep(0.25)
     STATUS_INDEX += 1
 
 def finish_status(msg=''):
-    sys.stderr.write('\n')
+    if not QUIET and is_tty():
+        sys.stderr.write('\n')
+
+def format_eta(seconds):
+    if seconds is None:
+        return '-:--'
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%i:%02i:%02i' % (hours, minutes, seconds)
+    return '%i:%02i' % (minutes, seconds)
+
+class Progress(object):
+    """Progress of a stage that processes total samples
+
+    Call update() with the number of samples done, from any thread. On a
+    terminal the status line shows the percentage, the throughput in MB/s
+    of decoded audio and the ETA. Otherwise a line like
+
+        progress stage=checksum samples=1048576/8467200 percent=12.4
+        mbps=31.2 elapsed=0.1 eta=0.9
+
+    (on one line) is written every PROGRESS_INTERVAL seconds and when the
+    stage is finished.
+    """
+    def __init__(self, stage, msg, total):
+        self.stage = stage
+        self.msg = msg
+        self.total = total
+        self.done = 0
+        self.started = time.time()
+        self.tty = is_tty()
+        self.interval = STATUS_INTERVAL if self.tty else PROGRESS_INTERVAL
+        self.last = self.started
+        self.lock = threading.Lock()
+
+    def update(self, samples):
+        with self.lock:
+            self.done += samples
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.show(now)
+
+    def finish(self):
+        with self.lock:
+            self.show(time.time())
+            if self.tty and not QUIET:
+                sys.stderr.write('\n')
+
+    def show(self, now):
+        if QUIET:
+            return
+        elapsed = now - self.started
+        rate = self.done/elapsed if elapsed > 0 else 0
+        percent = 100.0*self.done/self.total if self.total else 100.0
+        mbps = rate*BYTES_PER_SAMPLE/1e6
+        eta = (self.total - self.done)/rate if rate else None
+        if self.tty:
+            update_status('%s %5.1f%% %6.1f MB/s ETA %s', self.msg, percent,
+                          mbps, format_eta(eta))
+        else:
+            sys.stderr.write('progress stage=%s samples=%i/%i percent=%.1f '
+                             'mbps=%.1f elapsed=%.1f eta=%s\n' %
+                             (self.stage, self.done, self.total, percent,
+                              mbps, elapsed,
+                              '%.1f' % eta if eta is not None else '-'))
+            sys.stderr.flush()
 
 def get_num_samples(BIN, path):
+    num_samples = read_num_samples(path)
+    if num_samples is not None:
+        return num_samples
+
+    use_metaflac = fnmatch(path.lower(), '*.flac') and BIN['metaflac']
+    if not use_metaflac and not BIN.get('ffprobe'):
+        ext = splitext(path)[1].lower()
+        raise DependencyError('ffprobe required to read the length of %s '
+                              'files (%s)\n' % (ext or 'these', path))
     devnull = open(os.devnull, 'w')
-    if fnmatch(path.lower(), '*.flac') and BIN['metaflac']:
+    if use_metaflac:
         p = Popen([BIN['metaflac'], '--show-total-samples', path], stdout=PIPE)
         out, err = p.communicate()
         num_samples = int(out.strip())
@@ -130,19 +288,558 @@ def get_num_samples(BIN, path):
         p = Popen([BIN['ffprobe'], '-show_streams', path], stdout=PIPE,
                   stderr=devnull)
         out, err = p.communicate()
-        try:
-            dur = float(re.search(b'duration=([0-9.]+)', out).group(1))
-        except:
-            dur = 0
-        num_samples = int(round(dur*44100))
+        num_samples = parse_ffprobe_samples(out)
 
     devnull.close()
 
     return num_samples
 
+def parse_ffprobe_samples(out):
+    """Sample count from ffprobe -show_streams output
+
+    duration_ts counts time_base units, which for most audio streams are
+    samples, so it is exact where the float duration can round wrongly.
+    """
+    for stream in out.split(b'[STREAM]'):
+        if b'codec_type=audio' in stream:
+            out = stream
+            break
+    try:
+        ts = int(re.search(b'duration_ts=([0-9]+)', out).group(1))
+        num, den = re.search(b'time_base=([0-9]+)/([0-9]+)', out).groups()
+        return ts*int(num)*44100 // int(den)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        pass
+    try:
+        dur = float(re.search(b'duration=([0-9.]+)', out).group(1))
+    except (AttributeError, ValueError):
+        dur = 0
+    return int(round(dur*44100))
+
+def probe_num_samples(BIN, paths, jobs=PROBE_JOBS):
+    """Return the sample counts of paths
+
+    Counts are read from the file headers where possible; the remaining
+    files are probed with metaflac/ffprobe, jobs at a time.
+    """
+    counts = [read_num_samples(p) for p in paths]
+    pending = [i for i, n in enumerate(counts) if n is None]
+    while pending:
+        calls = [(i, BackgroundCall(get_num_samples, BIN, paths[i]))
+                 for i in pending[:jobs]]
+        for i, call in calls:
+            counts[i] = call.result()
+        pending = pending[jobs:]
+    return counts
+
+def read_num_samples(path):
+    """Exact number of 44.1 kHz samples from the header of path, or None
+
+    Understands FLAC, WAV/RF64, AIFF and WavPack.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+            f.seek(0)
+            if magic == b'fLaC' or magic[:3] == b'ID3':
+                return read_flac_samples(f)
+            if magic in (b'RIFF', b'RF64'):
+                offset, size, fmt = read_wav_header(f)
+                tag, channels, rate, bits = fmt
+                frame_size = channels*((bits+7)//8)
+                if rate != 44100 or not frame_size:
+                    return None
+                f.seek(0, 2)
+                return min(size, f.tell()-offset) // frame_size
+            if magic == b'FORM':
+                return read_aiff_samples(f)
+            if magic == b'wvpk':
+                return read_wavpack_samples(f)
+    except (IOError, OSError, ValueError, DecodeError, struct.error):
+        pass
+    return None
+
+def read_flac_samples(f):
+    header = f.read(10)
+    if header[:3] == b'ID3':
+        # ID3v2 tag in front of the stream, its size is syncsafe
+        size = 0
+        for b in bytearray(header[6:10]):
+            size = (size << 7) | (b & 0x7f)
+        f.seek(10 + size + (10 if bytearray(header)[5] & 0x10 else 0))
+    else:
+        f.seek(0)
+    block = f.read(4+4+18)
+    if block[:4] != b'fLaC' or bytearray(block)[4] & 0x7f != 0:
+        return None
+    # sample rate (20 bits), channels, bits per sample, total samples (36)
+    v = struct.unpack('>Q', block[18:26])[0]
+    total = v & 0xFFFFFFFFF
+    if v >> 44 != 44100 or not total:
+        return None
+    return total
+
+def read_aiff_samples(f):
+    form = f.read(12)
+    if form[8:12] not in (b'AIFF', b'AIFC'):
+        return None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id = header[:4]
+        size = struct.unpack('>I', header[4:])[0]
+        body = f.read(size + (size & 1))
+        if chunk_id == b'COMM' and len(body) >= 18:
+            frames = struct.unpack('>I', body[2:6])[0]
+            # sample rate is an 80 bit extended float
+            exponent, mantissa = struct.unpack('>HQ', body[8:18])
+            rate = mantissa >> (63 - ((exponent & 0x7fff) - 16383))
+            return frames if rate == 44100 else None
+
+def read_wavpack_samples(f):
+    header = f.read(32)
+    total_u8 = bytearray(header)[11]
+    total, index, samples, flags = struct.unpack('<IIII', header[12:28])
+    # sample rate index 9 is 44100 Hz
+    if total == 0xFFFFFFFF or (flags >> 23) & 0xf != 9:
+        return None
+    # total_samples_u8 holds the upper bits of a 40 bit count
+    return total + (total_u8 << 32) - total_u8
+
+def read_wav_header(f):
+    """Return (data offset, data size, (format, channels, rate, bits)) of
+    the open WAV or RF64 file f"""
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] not in (b'RIFF', b'RF64') or \
+            riff[8:12] != b'WAVE':
+        raise DecodeError('%s is not a WAV file' % f.name)
+
+    fmt = None
+    ds64_size = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise DecodeError('%s has no data chunk' % f.name)
+        chunk_id = header[:4]
+        size = struct.unpack('<I', header[4:])[0]
+        if chunk_id == b'data':
+            if size == 0xFFFFFFFF and ds64_size is not None:
+                size = ds64_size
+            if fmt is None:
+                raise DecodeError('%s has no fmt chunk' % f.name)
+            return f.tell(), size, fmt
+        body = f.read(size + (size & 1))
+        if chunk_id == b'fmt ' and len(body) >= 16:
+            fmt = struct.unpack('<HHIIHH', body[:16])
+            tag, channels, rate, bits = fmt[0], fmt[1], fmt[2], fmt[5]
+            # WAVE_FORMAT_EXTENSIBLE stores the real format in its subformat
+            if tag == 0xFFFE and len(body) >= 26:
+                tag = struct.unpack('<H', body[24:26])[0]
+            fmt = (tag, channels, rate, bits)
+        elif chunk_id == b'ds64' and len(body) >= 16:
+            ds64_size = struct.unpack('<Q', body[8:16])[0]
+
+def write_wav_header(f, num_samples):
+    """Write the header of a 16 bit stereo 44.1 kHz PCM WAV file"""
+    size = num_samples*BYTES_PER_SAMPLE
+    f.write(struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36+size, b'WAVE',
+                        b'fmt ', 16, 1, 2, 44100, 44100*BYTES_PER_SAMPLE,
+                        BYTES_PER_SAMPLE, 16, b'data', size))
+
+class MappedFile(object):
+    """CD audio stored uncompressed in a file, read through mmap
+
+    blocks() hands out slices of the mapping without copying.
+    """
+    def __init__(self, path, offset=0, size=None):
+        self.path = path
+        self.offset = offset
+        available = os.path.getsize(path) - offset
+        size = available if size is None else min(size, available)
+        self.num_samples = size // BYTES_PER_SAMPLE
+
+    def blocks(self, start=0, count=None, size=BLOCK_SAMPLES):
+        if count is None:
+            count = self.num_samples - start
+        if start + count > self.num_samples:
+            raise DecodeError('%s: unexpected end of audio' % self.path)
+        if count <= 0:
+            return
+
+        with open(self.path, 'rb') as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+        a = self.offset + start*BYTES_PER_SAMPLE
+        end = a + count*BYTES_PER_SAMPLE
+        while a < end:
+            b = min(a + size*BYTES_PER_SAMPLE, end)
+            yield view[a:b]
+            a = b
+
+def open_wav(path):
+    """Return a MappedFile for a 16 bit stereo 44.1 kHz PCM WAV file"""
+    with open(path, 'rb') as f:
+        offset, size, fmt = read_wav_header(f)
+    if fmt != (1, 2, 44100, 16):
+        raise DecodeError('%s is not 16 bit stereo 44.1 kHz PCM' % path)
+    return MappedFile(path, offset, size)
+
+class SndFile(object):
+    """File decoded in-process by libsndfile (through pysoundfile)"""
+    def __init__(self, path):
+        self.path = path
+        try:
+            info = soundfile.info(path)
+        except RuntimeError as e:
+            raise DecodeError('%s: %s' % (path, e))
+        if (info.samplerate, info.channels, info.subtype) != \
+                (44100, 2, 'PCM_16'):
+            raise DecodeError('%s is not 16 bit stereo 44.1 kHz' % path)
+        self.num_samples = info.frames
+
+    def blocks(self, start=0, count=None, size=BLOCK_SAMPLES):
+        if count is None:
+            count = self.num_samples - start
+        done = 0
+        with soundfile.SoundFile(self.path) as f:
+            if start:
+                f.seek(start)
+            for a in f.blocks(blocksize=size, frames=count, dtype='<i2'):
+                done += len(a)
+                yield a.reshape(-1).view('u1')
+        if done < count:
+            raise DecodeError('%s: unexpected end of audio' % self.path)
+
+class PipeFile(object):
+    """File decoded by sox, or by ffmpeg if there's no sox"""
+    def __init__(self, BIN, path, procs=None):
+        self.path = path
+        self.procs = [] if procs is None else procs
+        self.sox = BIN.get('sox')
+        self.ffmpeg = BIN.get('ffmpeg')
+        if not self.sox and not self.ffmpeg:
+            raise DependencyError('sox or ffmpeg required to decode %s\n' %
+                                  path)
+
+    def args(self, start=0):
+        if self.sox:
+            args = [self.sox, self.path] + SOX_RAW_ARGS + ['-']
+            if start:
+                args += ['trim', '%is' % start]
+        else:
+            args = [self.ffmpeg, '-v', 'error', '-i', self.path]
+            if start:
+                args += ['-af', 'atrim=start_sample=%i' % start]
+            args += ['-f', 's16le', '-ac', '2', '-ar', '44100', '-']
+        return args
+
+    def blocks(self, start=0, count=None, size=BLOCK_SAMPLES):
+        args = self.args(start)
+        p = Popen(args, stdout=PIPE)
+        self.procs.append(p)
+        done = 0
+        eof = False
+        try:
+            while count is None or done < count:
+                n = size if count is None else min(size, count-done)
+                data = p.stdout.read(n*BYTES_PER_SAMPLE)
+                if not data:
+                    eof = True
+                    break
+                if len(data) % BYTES_PER_SAMPLE:
+                    raise DecodeError('%s: partial sample' % self.path)
+                done += len(data) // BYTES_PER_SAMPLE
+                if PROFILE:
+                    PROFILE.piped(p, len(data), stdout=True)
+                yield data
+        finally:
+            p.stdout.close()
+            if not eof and p.poll() is None:
+                p.kill()
+            wait_process(p)
+
+        if eof and p.returncode:
+            raise SubprocessError('%s had an error (returned %i)' %
+                                  (basename(args[0]), p.returncode))
+        if count is not None and done < count:
+            raise DecodeError('%s: unexpected end of audio' % self.path)
+
+def open_audio(BIN, path, procs=None):
+    """Return a decoder for path with num_samples and a blocks() generator
+
+    blocks(start, count, size) yields exactly count samples from start as
+    buffers of at most size samples. WAV and raw files are memory mapped,
+    FLAC is decoded in-process if pysoundfile is installed. Anything else
+    is piped through sox or ffmpeg; those decoders have no num_samples.
+    """
+    ext = splitext(path)[1].lower()
+    try:
+        if ext in WAV_EXTENSIONS:
+            return open_wav(path)
+        if ext in RAW_EXTENSIONS:
+            return MappedFile(path)
+        if ext == '.flac' and soundfile is not None:
+            return SndFile(path)
+    except DecodeError:
+        pass
+    return PipeFile(BIN, path, procs)
+
+def album_ranges(files, start, count):
+    """Split count samples of the album made of files from sample start on
+    into (file index, start in file, count) pieces
+
+    files is a list of (path, num_samples). Pieces before the start or
+    past the end of the album are silence and have index None.
+    """
+    if start < 0:
+        n = min(-start, count)
+        yield None, 0, n
+        start += n
+        count -= n
+    pos = 0
+    for i, (path, length) in enumerate(files):
+        if count <= 0:
+            break
+        if start < pos + length:
+            n = min(pos + length - start, count)
+            yield i, start - pos, n
+            start += n
+            count -= n
+        pos += length
+    if count > 0:
+        yield None, 0, count
+
+def album_blocks(BIN, files, start, count, procs=None, jobs=1):
+    """Yield count samples of the album made of files from sample start on
+
+    Silence is added before the start and past the end of the album (see
+    album_ranges), so a range moved by an offset can be read directly.
+    Only the files the range touches are decoded, up to jobs of them at a
+    time (see ordered_blocks).
+    """
+    sources = []
+    for i, a, n in album_ranges(files, start, count):
+        if i is None:
+            sources.append(lambda n=n: [b'\0'*(n*BYTES_PER_SAMPLE)])
+        else:
+            sources.append(lambda i=i, a=a, n=n:
+                           open_audio(BIN, files[i][0], procs).blocks(a, n))
+    return ordered_blocks(sources, jobs)
+
+def ordered_blocks(sources, jobs=1, buffered=DECODE_BUFFER):
+    """Yield the blocks of every source in order, decoding up to jobs
+    sources ahead at a time
+
+    sources are functions returning an iterator of blocks, like
+    lambda: audio.blocks(start, count). Each one decoded ahead runs in a
+    thread and fills its own queue of at most buffered blocks, so memory
+    use stays bounded however far behind the consumer is. A decoding error
+    is raised when its source's turn comes. Closing the generator stops
+    the decoders.
+    """
+    sources = list(sources)
+    if jobs <= 1 or len(sources) <= 1:
+        for source in sources:
+            for block in source():
+                yield block
+        return
+
+    BLOCK, ERROR, DONE = range(3)
+    stop = threading.Event()
+    queues = []
+    threads = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def decode(source, q):
+        try:
+            blocks = source()
+            if PROFILE:
+                blocks = profile_blocks(blocks, 'decode-ahead')
+            try:
+                for block in blocks:
+                    if not put(q, (BLOCK, block)):
+                        return
+            finally:
+                close = getattr(blocks, 'close', None)
+                if close:
+                    close()
+        except Exception as e:
+            put(q, (ERROR, e))
+        else:
+            put(q, (DONE, None))
+
+    def start(i):
+        q = Queue(buffered)
+        t = threading.Thread(target=decode, args=(sources[i], q))
+        t.daemon = True
+        t.start()
+        queues.append(q)
+        threads.append(t)
+
+    try:
+        for i in range(min(jobs, len(sources))):
+            start(i)
+        for i in range(len(sources)):
+            while True:
+                try:
+                    # with a timeout, so signals get through on python 2
+                    kind, item = queues[i].get(timeout=1)
+                except Empty:
+                    continue
+                if kind == BLOCK:
+                    yield item
+                elif kind == ERROR:
+                    raise item
+                else:
+                    break
+            # the decoder of source i is done, start the next one
+            queues[i] = None
+            if i + jobs < len(sources):
+                start(i + jobs)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+def copy_range(src, dst, offset, size):
+    """Copy size bytes from offset of file src to the position of file dst
+
+    The kernel copies the data if it can (copy_file_range or sendfile).
+    """
+    dst.flush()
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+        try:
+            while size:
+                if name == 'copy_file_range':
+                    n = copy(src.fileno(), dst.fileno(), size, offset)
+                else:
+                    n = copy(dst.fileno(), src.fileno(), offset, size)
+                if not n:
+                    raise DecodeError('%s: unexpected end of file' %
+                                      src.name)
+                offset += n
+                size -= n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    src.seek(offset)
+    while size:
+        data = src.read(min(size, BLOCK_SAMPLES*BYTES_PER_SAMPLE))
+        if not data:
+            raise DecodeError('%s: unexpected end of file' % src.name)
+        dst.write(data)
+        size -= len(data)
+
+def write_blocks(p, blocks, progress=None):
+    """Write blocks to the stdin of p, wait for it and return its return code
+
+    progress is a Progress updated with the samples written. p may exit
+    before it has read everything.
+    """
+    if PROFILE:
+        blocks = profile_blocks(blocks, 'decode')
+    name = 'pipe:%s' % PROFILE.process(p)['program'] if PROFILE else None
+    try:
+        for block in blocks:
+            with profile_stage(name, len(block)):
+                p.stdin.write(block)
+            if PROFILE:
+                PROFILE.piped(p, len(block))
+            if progress:
+                progress.update(len(block)//BYTES_PER_SAMPLE)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        # p sees the end of its input even if decoding failed
+        try:
+            p.stdin.close()
+        except (IOError, OSError):
+            pass
+    return wait_process(p)
+
+def wait_process(p):
+    """p.wait(); while profiling the resources used by p are recorded"""
+    if PROFILE:
+        return PROFILE.wait(p)
+    return p.wait()
+
+@contextmanager
+def profile_stage(name, nbytes=0):
+    """Add the time spent in the with block to stage name of PROFILE"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        if PROFILE and name:
+            PROFILE.add(name, time.time() - start, nbytes)
+
+def profile_blocks(blocks, name):
+    """Yield blocks, adding the time spent producing each to stage name"""
+    blocks = iter(blocks)
+    try:
+        while True:
+            start = time.time()
+            try:
+                block = next(blocks)
+            except StopIteration:
+                return
+            if PROFILE:
+                PROFILE.add(name, time.time() - start, len(block))
+            yield block
+    finally:
+        close = getattr(blocks, 'close', None)
+        if close:
+            close()
+
+class BackgroundCall(threading.Thread):
+    """Runs func(*args) in a thread; result() waits for its return value
+    and reraises its exception, if any"""
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
 def abort(*args):
     raise KilledError
 
+def init_worker():
+    """Leave signal handling of pool workers to the parent process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for sig in filter(None, [getattr(signal, s, None) for s in
+                             "SIGTERM SIGHUP".split()]):
+        signal.signal(sig, signal.SIG_DFL)
+
 def execute(main, process_arguments, processes, tempfiles=[], tempdirs=[]):
     options = None
     try:
@@ -155,7 +852,8 @@ def execute(main, process_arguments, processes, tempfiles=[], tempdirs=[]):
     except KilledError:
         exitcode = 1
     except (DependencyError, AccurateripError, SubprocessError,
-            NotFromCDError, NetworkError) as e:
+            NotFromCDError, NetworkError, DecodeError, CueError,
+            MirrorError) as e:
         print(e, file=sys.stderr)
         sys.stderr.write('%s\n' % e)
         exitcode = 2